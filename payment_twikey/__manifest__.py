@@ -29,6 +29,9 @@
         "wizard/twikey_contract_template_wizard.xml",
         "views/mandate_details.xml",
         "views/account_move.xml",
+        "views/feed_dead_letter.xml",
+        "views/feed_checkpoint.xml",
+        "views/outbox.xml",
         "report/report_account_invoice.xml",
     ],
     'application': False,
@@ -43,46 +43,12 @@ class TwikeyController(http.Controller):
             return Response(response="invalid signature", status=403)
 
         _logger.info("Twikey: entering webhook with post data %s", pprint.pformat(object=post, compact=True))
-        webhooktype = post.get("type")
-        if webhooktype == "payment":
-            if post.get("id"):
-                request.env['payment.transaction'].sudo()._handle_notification_data('twikey', post)
-            else:
-                request.env["account.move"].sudo().update_invoice_feed(company)
-            return Response(status=204)
-        elif webhooktype == "contract":
-            mandate_number = post.get("mandateNumber")
-            if mandate_number:
-                # Removal of a prepared mandate doesn't show up in the feed
-                mandate_id = request.env["twikey.mandate.details"].sudo().search([("reference", "=", mandate_number)])
-                if mandate_id:
-                    event = post.get("event")
-                    if event == "Invite":
-                        reason = post.get("reason")
-                        if reason == "removed":
-                            _logger.info(f"Removing twikey mandate {mandate_number}")
-                            mandate_id.with_context(update_feed=True).unlink()
-                        elif reason == "expired":
-                            if mandate_id.contract_temp_id.mandate_number_required:
-                                _logger.info(f"Not removing expired (mandate_number_required) {mandate_number}")
-                                mandate_id.message_post(body=f"Ignoring expiry for Twikey mandate {mandate_number}")
-                            else:
-                                _logger.info(f"Removing expired twikey mandate {mandate_number}")
-                                mandate_id.with_context(update_feed=True).unlink()
-                        else:
-                            _logger.warning("Unknown twikey mandate event of type "+event)
-                    else:
-                        if event not in ["Sign", "Update"]:
-                            _logger.info("Unknown twikey mandate event of type "+event)
-                        request.env["twikey.mandate.details"].sudo().update_feed(company)
-                else:
-                    request.env["twikey.mandate.details"].sudo().update_feed(company)
-            return Response(status=204)
-        elif webhooktype == "event" and post.get("msg") == "dummytest":
+        if post.get("type") == "event" and post.get("msg") == "dummytest":
             _logger.info("Twikey Webhook test successful!")
-            return Response(status=204)
-        else:
-            return Response(status=204)
+        elif post.get("type") in ("payment", "contract"):
+            # handled in the background, so bursts and retries of Twikey don't keep the http workers busy
+            request.env["twikey.webhook.event"].sudo().receive(company or request.env.company, post)
+        return Response(status=204)
 
     @http.route("/twikey/status", type='http', auth='public', methods=['GET', 'POST'], csrf=False, save_session=False)
     def twikey_return_from_checkout(self, **data):
@@ -6,6 +6,12 @@ from . import account_move
 from . import twikey_contract_template
 from . import sale_order
 from . import ir_config_parameter
+from . import twikey_session_token
+from . import twikey_feed_checkpoint
+from . import twikey_feed_dead_letter
+from . import twikey_webhook_event
+from . import twikey_outbox
+from . import twikey_invoice_queue
 from . import twikey_sync_contract_templates
 from . import payment_acquirer
 from . import payment_token
@@ -1,14 +1,14 @@
-import base64
+import hashlib
 import logging
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from odoo import _, api, fields, models, Command
 from odoo.exceptions import UserError
-import psycopg2
 
 from ..twikey.client import TwikeyError
 from ..twikey.invoice import InvoiceFeed
-from ..utils import get_twikey_customer, get_error_msg, get_success_msg
+from ..utils import get_twikey_customer, get_error_msg, get_success_msg, submit_concurrently, failed_call, collect, commit, feed_lock, FEED_BUSY, TimeBudget
 
 F_INCLUDE_PDF_INVOICE = "include_pdf_invoice"
 F_AUTO_COLLECT_INVOICE = "auto_collect_invoice"
@@ -59,156 +59,406 @@ class AccountInvoice(models.Model):
         self.env['mail.channel'].search([('name', '=', 'twikey')]).message_post(subject="Prepare for sending", body = msg)
         return get_success_msg(msg)
 
-    def send_invoices(self):
-        """ Collect all invoices to be sent to twikey """
-        twikey_client = (self.env["ir.config_parameter"].sudo().get_twikey_client(company=self.env.company))
-        if twikey_client:
-            # sometimes action_post gets called without an invoice record, in this case we don't try to
-            # send anything to Twikey
-            to_be_send = self.search([('send_to_twikey', '=', True),('twikey_invoice_identifier','=',False),('state','=','posted')])
+    @api.model
+    def _cron_send_invoices(self, helper=0):
+        """ Send the invoices of every company configured for Twikey, at most twikey.send_max_per_run per company """
+        if not helper:
+            self.env["res.company"]._twikey_start_helpers("payment_twikey.twikey_invoice_sender")
+        elif helper >= self.env["res.company"]._twikey_cron_workers():
+            # a helper running on its own schedule while fewer workers are asked for
+            return
+        limit = int(self.env["ir.config_parameter"].sudo().get_param("twikey.send_max_per_run", 1000))
+        budget = TimeBudget.for_cron(self.env)
+        more = self.env["res.company"]._twikey_run_for_companies(
+            False, lambda company: self.with_company(company).send_invoices(company, limit, budget), budget
+        )
+        if more:
+            self.env.ref("payment_twikey.twikey_invoice_sender")._trigger()
+
+    def send_invoices(self, company = None, limit = None, budget = None):
+        """
+        Collect all invoices of the company to be sent to twikey, committing after every chunk
+        :param budget: TimeBudget, stop sending once it is used up
+        :return: True when more invoices than limit are waiting to be sent or the budget was used up
+        """
+        if not company:
+            company = self.env.company
+        twikey_client = (self.env["ir.config_parameter"].sudo().get_twikey_client(company=company))
+        if not twikey_client:
+            _logger.info("Not sending to Twikey as not configured")
+            return False
+        with feed_lock(self.env, company, "sender") as locked:
+            if not locked:
+                return False
+            queue = self.env["twikey.invoice.queue"].sudo()
+            to_be_send = queue.pending_moves(company, limit)
             if len(to_be_send) > 0:
                 # ensure logged in otherwise company of url might not be filled in
                 twikey_client.refreshTokenIfRequired()
 
-            to_be_send.transfer_to_twikey(twikey_client)
-        else:
-            _logger.info("Not sending to Twikey as not configured")
+            chunk_size = int(self.env["ir.config_parameter"].sudo().get_param("twikey.send_chunk_size", 100))
+            for offset in range(0, len(to_be_send), chunk_size):
+                if budget and budget.expired():
+                    _logger.info(f"Twikey invoice sender out of time, {len(to_be_send) - offset} invoice(s) left for the next run")
+                    return True
+                chunk = to_be_send[offset:offset + chunk_size]
+                chunk.transfer_to_twikey(twikey_client)
+                queue.processed(chunk)
+                commit(self.env)
+            # invoices that failed are only picked up again after their backoff
+            return bool(limit) and len(to_be_send) == limit
 
     def transfer_to_twikey(self, twikeyClient):
         """ Actual sending of twikey """
-        for invoice in self:
-
-            # Handle as refund
-            if invoice.is_purchase_document():
-                if invoice.amount_total == 0:
-                    invoice.message_post(body="Skipping sending to Twikey as no open amount.")
-                    invoice.with_context(update_feed=True).write({"send_to_twikey": False})
-                else:
-                    partner_id = invoice.partner_id
-                    customer_bank_id = partner_id.bank_ids.filtered((lambda p: p.allow_out_payment))
-                    if len(customer_bank_id) > 0:
-                        iban = customer_bank_id[0].sanitized_acc_number
-                        if customer_bank_id[0].sequence != 20:
-                            payload = get_twikey_customer(partner_id)
-                            payload["iban"] = iban
-                            if customer_bank_id[0].bank_id and customer_bank_id[0].bank_id.bic:
-                                payload["bic"] = customer_bank_id[0].bank_id.bic
-                            twikeyClient.refund.create_beneficiary_account(payload)
-                            customer_bank_id[0].write({"sequence":20})
-                            partner_id.message_post(body=f"Twikey beneficiary account to {iban} was added")
-
-                        refund = twikeyClient.refund.create(partner_id.id,{
-                            "iban": iban,
-                            "message": invoice.payment_reference,
-                            "amount":  invoice.amount_total,
-                            "ref": invoice.name,
-                        })
-
-                        # make payment
-                        self.env['account.payment.register'].with_context(
-                            {"dont_redirect_to_payments":True},
-                            active_model='account.move',active_ids=invoice.ids,).create({'payment_date': invoice.date,}).action_create_payments()
+        params = self.env["ir.config_parameter"].sudo()
+        # invoices rendered (with a single wkhtmltopdf run) and sent at once
+        render_size = int(params.get_param("twikey.render_batch_size", 20))
+        workers = int(params.get_param("twikey.send_workers", 8))
+
+        # Refunds register payments in Odoo, so these are handled one by one
+        refunds = self.filtered(lambda move: move.is_purchase_document())
+        errors = []
+        for refund in refunds:
+            try:
+                # a failing refund neither undoes the ones before nor stops the others, it is retried later
+                with self.env.cr.savepoint():
+                    refund._transfer_refund_to_twikey(twikeyClient)
+            except Exception as e:
+                refund.message_post(body=f"Exception raised while sending : {e}")
+                errors.append(e)
+                _logger.error("Exception raised while sending refund %s to Twikey :\n%s" % (refund.name, e))
+
+        invoices = self - refunds
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="twikey") as executor:
+            in_flight = []
+            try:
+                for offset in range(0, len(invoices), render_size):
+                    # rendered while Twikey handles the previous batch
+                    in_flight.append(invoices[offset:offset + render_size]._start_transfer_to_twikey(twikeyClient, executor))
+                    if len(in_flight) > 1:
+                        errors += self._finish_transfer_to_twikey(in_flight.pop(0))
+            except Exception:
+                # the invoices Twikey accepted must survive the rollback following the error, or they'd be sent
+                # again under a new id
+                while in_flight:
+                    self._finish_transfer_to_twikey(in_flight.pop(0))
+                commit(self.env)
+                raise
+            while in_flight:
+                errors += self._finish_transfer_to_twikey(in_flight.pop(0))
+        if errors:
+            return get_error_msg(str(errors[0]), 'Exception raised while creating a new Invoice')
+
+    def _transfer_refund_to_twikey(self, twikeyClient):
+        invoice = self
+        if invoice.amount_total == 0:
+            invoice.message_post(body="Skipping sending to Twikey as no open amount.")
+            invoice.with_context(update_feed=True).write({"send_to_twikey": False})
+        else:
+            partner_id = invoice.partner_id
+            customer_bank_id = partner_id.bank_ids.filtered((lambda p: p.allow_out_payment))
+            if len(customer_bank_id) > 0:
+                iban = customer_bank_id[0].sanitized_acc_number
+                if customer_bank_id[0].sequence != 20:
+                    payload = get_twikey_customer(partner_id)
+                    payload["iban"] = iban
+                    if customer_bank_id[0].bank_id and customer_bank_id[0].bank_id.bic:
+                        payload["bic"] = customer_bank_id[0].bank_id.bic
+                    twikeyClient.refund.create_beneficiary_account(payload)
+                    customer_bank_id[0].write({"sequence":20})
+                    partner_id.message_post(body=f"Twikey beneficiary account to {iban} was added")
+
+                refund = twikeyClient.refund.create(partner_id.id,{
+                    "iban": iban,
+                    "message": invoice.payment_reference,
+                    "amount":  invoice.amount_total,
+                    "ref": invoice.name,
+                })
+
+                # make payment
+                self.env['account.payment.register'].with_context(
+                    {"dont_redirect_to_payments":True},
+                    active_model='account.move',active_ids=invoice.ids,).create({'payment_date': invoice.date,}).action_create_payments()
+
+                invoice.with_context(update_feed=True).write({
+                    "twikey_invoice_identifier": refund["id"],
+                })
+            else:
+                invoice.message_post(body="Skipping sending to Twikey as no accounts allowing out_payments.")
+                invoice.with_context(update_feed=True).write({"send_to_twikey": False})
 
-                        invoice.with_context(update_feed=True).write({
-                            "twikey_invoice_identifier": refund["id"],
-                        })
-                    else:
-                        invoice.message_post(body="Skipping sending to Twikey as no accounts allowing out_payments.")
-                        invoice.with_context(update_feed=True).write({"send_to_twikey": False})
-                continue
+    def _start_transfer_to_twikey(self, twikeyClient, executor):
+        """
+        Build the payloads of a batch of invoices (rendering their pdfs together) and start sending them
+        concurrently on the executor without waiting for Twikey, see _finish_transfer_to_twikey
+        """
+        to_send = []
+        invoices = self.filtered(lambda invoice: invoice.amount_residual != 0)
+        for invoice in self - invoices:
+            invoice.with_context(update_feed=True).write({"send_to_twikey": False})
+            invoice.message_post(body="Skipping sending to Twikey as no open amount.")
+        pdfs, render_errors = invoices.filtered(
+            lambda invoice: invoice.include_pdf_invoice and not invoice.reversed_entry_id
+        )._get_twikey_pdfs()
+        failed = []
+        for invoice in invoices:
+            if invoice.id in render_errors:
+                # reported with the results of the others, the rest of the batch is sent anyway
+                failed.append(failed_call((invoice, None, None), render_errors[invoice.id]))
+            else:
+                to_send.append((invoice, invoice._prepare_twikey_invoice(), pdfs.get(invoice.id)))
 
-            if invoice.amount_residual == 0:
-                invoice.with_context(update_feed=True).write({"send_to_twikey": False})
-                invoice.message_post(body="Skipping sending to Twikey as no open amount.")
-                continue
+        def send(item):
+            # the pdf is base64 encoded while being sent
+            return twikeyClient.invoice.create(item[1], "Odoo", pdf=item[2])
 
-            invoice_uuid = str(uuid.uuid4())
+        return submit_concurrently(executor, send, to_send) + failed
 
-            report_file = False
-            credit_note_for = False
-            if invoice.reversed_entry_id:
-                amount = -invoice.amount_total
-                credit_note_for = invoice.reversed_entry_id.name
-                remittance = _("CreditNote for %s") % invoice.reversed_entry_id.name
+    def _finish_transfer_to_twikey(self, started):
+        """
+        Wait for the invoices sent by _start_transfer_to_twikey and store the results with a single update.
+        :return: list of errors
+        """
+        sent = []
+        errors = []
+        for (invoice, data, _pdf), twikey_invoice, e in collect(started):
+            if e is None:
+                sent.append((invoice.id, data["id"], twikey_invoice.get("state")))
             else:
-                amount = invoice.amount_total
-                invoice_report = self.env.ref("account.account_invoices")
-                if invoice.include_pdf_invoice:
-                    report_file = base64.b64encode(
-                        self.env["ir.actions.report"]
-                        .sudo()
-                        ._render_qweb_pdf(invoice_report, [invoice.id], data=None)[0]
-                    )
-                remittance = invoice.payment_reference
-
-            try:
-                today = invoice.date.isoformat()
-                twikey_customer = get_twikey_customer(invoice.partner_id)
-                data = {
-                    "id": invoice_uuid,
-                    "number": invoice.name,
-                    "title": invoice.name,
-                    "ct": invoice.twikey_template_id.template_id_twikey,
-                    "amount": amount,
-                    "date": invoice.invoice_date.isoformat(),
-                    "duedate": invoice.invoice_date_due.isoformat() if invoice.invoice_date_due else today,
-                    "remittance": remittance,
-                    "ref": invoice.id,
-                    "locale": twikey_customer["l"] if twikey_customer else "en",
-                    "customer": twikey_customer,
-                }
-
-                if not invoice.auto_collect_invoice:
-                    data["manual"] = "true"
-
-                if invoice.is_purchase_document():
-                    data["refund"] = "try"
-
-                if report_file:
-                    data["pdf"] = report_file.decode("utf-8")
-                if credit_note_for:
-                    data["relatedInvoiceNumber"] = credit_note_for
-
-                twikey_invoice = twikeyClient.invoice.create(data, "Odoo")
-                new_state = {
-                    "twikey_invoice_identifier": invoice_uuid,
-                    "twikey_invoice_state": twikey_invoice.get("state")
-                }
-                invoice.with_context(update_feed=True).write(new_state)
-            except TwikeyError as e:
-                errmsg = "Exception raised while sending %s to Twikey :\n%s" % (invoice.name, e)
+                # keep going, the ones that were accepted by Twikey must be stored
                 invoice.message_post(body=f"Exception raised while sending : {e}")
-                self.env['mail.channel'].search([('name', '=', 'twikey')]).message_post(subject="Invoices",body=errmsg,)
-                _logger.error(errmsg)
-                return get_error_msg(str(e), 'Exception raised while creating a new Invoice')
-
-    def update_invoice_feed(self, company = None):
+                errors.append(e)
+                _logger.error("Exception raised while sending %s to Twikey :\n%s" % (invoice.name, e))
+        self._store_twikey_invoices(sent)
+
+        if errors:
+            errmsg = "Exception raised while sending %d invoice(s) to Twikey :\n%s" % (len(errors), "\n".join(str(e) for e in errors))
+            self.env['mail.channel'].search([('name', '=', 'twikey')]).message_post(subject="Invoices",body=errmsg,)
+        return errors
+
+    def _prepare_twikey_invoice(self):
+        """ Build the payload of the invoice as expected by Twikey, without the pdf (see _get_twikey_pdfs) """
+        invoice = self
+        invoice_uuid = str(uuid.uuid4())
+
+        credit_note_for = False
+        if invoice.reversed_entry_id:
+            amount = -invoice.amount_total
+            credit_note_for = invoice.reversed_entry_id.name
+            remittance = _("CreditNote for %s") % invoice.reversed_entry_id.name
+        else:
+            amount = invoice.amount_total
+            remittance = invoice.payment_reference
+
+        today = invoice.date.isoformat()
+        twikey_customer = get_twikey_customer(invoice.partner_id)
+        data = {
+            "id": invoice_uuid,
+            "number": invoice.name,
+            "title": invoice.name,
+            "ct": invoice.twikey_template_id.template_id_twikey,
+            "amount": amount,
+            "date": invoice.invoice_date.isoformat(),
+            "duedate": invoice.invoice_date_due.isoformat() if invoice.invoice_date_due else today,
+            "remittance": remittance,
+            "ref": invoice.id,
+            "locale": twikey_customer["l"] if twikey_customer else "en",
+            "customer": twikey_customer,
+        }
+
+        if not invoice.auto_collect_invoice:
+            data["manual"] = "true"
+
+        if credit_note_for:
+            data["relatedInvoiceNumber"] = credit_note_for
+        return data
+
+    def _get_twikey_pdfs(self):
+        """
+        PDFs of the invoices by move id, reusing the ones Odoo already has as rendering is the most expensive part
+        of sending. All others are rendered with a single wkhtmltopdf run, split per invoice afterwards. When that
+        fails they are rendered one by one, so a single invoice that can't be rendered doesn't hold up the others.
+        :return: pdfs by move id, rendering errors by move id
+        """
+        report = self.env.ref("account.account_invoices").sudo()
+        pdfs = {}
+        errors = {}
+        for move in self:
+            pdf = move._find_twikey_pdf(report)
+            if pdf:
+                pdfs[move.id] = pdf
+        missing = self.filtered(lambda move: move.id not in pdfs)
+        if not missing:
+            return pdfs, errors
+
+        _logger.debug(f"Rendering {len(missing)} invoice pdf(s) for Twikey")
+        try:
+            with self.env.cr.savepoint():
+                pdfs.update(missing._render_twikey_pdfs(report))
+        except Exception as e:
+            if len(missing) == 1:
+                errors[missing.id] = e
+                return pdfs, errors
+            _logger.warning(f"Rendering {len(missing)} invoice pdfs for Twikey failed ({e}), rendering them one by one")
+            for move in missing:
+                try:
+                    with self.env.cr.savepoint():
+                        pdfs.update(move._render_twikey_pdfs(report))
+                except Exception as error:
+                    _logger.error(f"Unable to render the pdf of {move.name} for Twikey: {error}")
+                    errors[move.id] = error
+        return pdfs, errors
+
+    def _render_twikey_pdfs(self, report):
+        """ Render the pdfs of the moves with a single wkhtmltopdf run, :return: pdfs by move id """
+        reports = self.env["ir.actions.report"].sudo()
+        pdfs = {}
+        streams = reports._render_qweb_pdf_prepare_streams(report, None, res_ids=self.ids)
+        try:
+            if report.attachment:
+                # saved like _render_qweb_pdf would
+                attachment_vals_list = reports._prepare_pdf_report_attachment_vals_list(report, streams)
+                if attachment_vals_list:
+                    self.env["ir.attachment"].sudo().create(attachment_vals_list)
+            for move in self:
+                stream = streams.get(move.id, {}).get("stream")
+                if stream:
+                    pdfs[move.id] = stream.getvalue()
+                else:
+                    # wkhtmltopdf output that couldn't be split per invoice
+                    pdfs[move.id] = reports._render_qweb_pdf(report, [move.id], data=None)[0]
+                if not (report.attachment and report.retrieve_attachment(move)):
+                    move._cache_twikey_pdf(pdfs[move.id])
+        finally:
+            for stream_data in streams.values():
+                if stream_data.get("stream"):
+                    stream_data["stream"].close()
+        return pdfs
+
+    def _twikey_pdf_cache(self):
+        """ :return: name, key (valid as long as the invoice didn't change) and attachments of the cached pdf """
+        name = f"twikey_{(self.name or 'INV').replace('/', '_')}.pdf"
+        key = hashlib.sha256(f"{self.id}:{self.write_date}".encode()).hexdigest()
+        cached = self.env["ir.attachment"].sudo().search([
+            ("res_model", "=", self._name), ("res_id", "=", self.id), ("name", "=", name)
+        ])
+        return name, key, cached
+
+    def _find_twikey_pdf(self, report):
+        """ PDF saved when the invoice was printed or sent, or rendered by an earlier attempt to send it """
+        attachment = report.attachment and report.retrieve_attachment(self)
+        if not attachment:
+            # only the invoice report as saved when sending it, any other pdf (eg. a scan) could be the main one
+            main = self.message_main_attachment_id
+            if (main.mimetype == "application/pdf" and main.res_model == self._name and main.res_id == self.id
+                    and main.name == f"{self._get_report_base_filename()}.pdf"):
+                attachment = main
+        if not attachment:
+            _name, key, cached = self._twikey_pdf_cache()
+            attachment = cached.filtered(lambda cache: cache.description == key)[:1]
+        if attachment:
+            _logger.debug(f"Reusing {attachment.name} for {self.name}")
+            return attachment.raw
+        return False
+
+    def _cache_twikey_pdf(self, pdf):
+        """ Keep a pdf the report doesn't save itself for a retry (the filestore dedupes it by checksum) """
+        name, key, cached = self._twikey_pdf_cache()
+        cached.unlink()
+        self.env["ir.attachment"].sudo().create({
+            "name": name,
+            "description": key,
+            "raw": pdf,
+            "mimetype": "application/pdf",
+            "res_model": self._name,
+            "res_id": self.id,
+        })
+
+    def _store_twikey_invoices(self, sent):
+        """
+        Store identifier and state of the invoices accepted by Twikey in one update
+        :param sent: list of (move id, twikey invoice id, twikey state)
+        """
+        if not sent:
+            return
+        fnames = ["twikey_invoice_identifier", "twikey_invoice_state"]
+        self.flush_model(fnames)
+        query = """UPDATE account_move m SET twikey_invoice_identifier = v.identifier, twikey_invoice_state = v.state
+                     FROM (VALUES %s) AS v(id, identifier, state) WHERE m.id = v.id""" % ", ".join(["%s"] * len(sent))
+        self._cr.execute(query, sent)
+        moves = self.browse([move_id for move_id, _identifier, _state in sent])
+        moves.invalidate_recordset(fnames)
+        # twikey_url depends on the identifier
+        moves.modified(fnames)
+
+    @api.model
+    def _cron_update_invoice_feed(self, helper=0):
+        """ Invoice feed of every company configured for Twikey, the least recently updated first """
+        if not helper:
+            self.env["res.company"]._twikey_start_helpers("payment_twikey.twikey_update_invoice_feed")
+        elif helper >= self.env["res.company"]._twikey_cron_workers():
+            # a helper running on its own schedule while fewer workers are asked for
+            return
+        max_pages = int(self.env["ir.config_parameter"].sudo().get_param("twikey.feed_max_pages", 50))
+        budget = TimeBudget.for_cron(self.env)
+        more = self.env["res.company"]._twikey_run_for_companies(
+            "invoice", lambda company: self.with_company(company).update_invoice_feed(company, max_pages, budget), budget
+        )
+        if more:
+            self.env.ref("payment_twikey.twikey_update_invoice_feed")._trigger()
+
+    def update_invoice_feed(self, company = None, max_pages = None, budget = None):
+        """
+        :param max_pages: stop after this many pages so other companies get their turn
+        :param budget: TimeBudget, stop after the page during which it was used up
+        :return: True when stopped because of max_pages or the budget, FEED_BUSY when another worker runs it
+        """
         if not company:
             company = self.env.company
-        try:
-            # set lock on res_company to avoid duplicate calls
-            self._cr.execute(f"""SELECT id FROM res_company WHERE id = %s FOR UPDATE NOWAIT""", [company.id], log_exceptions=False)
-            _logger.debug(f"Fetching Twikey updates from {company.invoice_feed_pos}")
-            twikey_client = self.env["ir.config_parameter"].get_twikey_client(company=company)
-            if twikey_client:
-                twikey_client.invoice.feed(OdooInvoiceFeed(self.env,company), company.invoice_feed_pos,"meta","lastpayment")
-        except TwikeyError as e:
-            if e.error_code != "err_call_in_progress":  # ignore parallel calls
-                errmsg = "Exception raised while fetching updates:\n%s" % (e)
-                self.env['mail.channel'].search([('name', '=', 'twikey')]).message_post(subject="Invoices",body=errmsg,)
-        except psycopg2.OperationalError:
-            _logger.debug("Operation already ongoing")
+        # companies sharing a Twikey account share the feed too
+        company = company._twikey_account_companies()[0]
+        more = False
+        with feed_lock(self.env, company, "invoice") as locked:
+            if not locked:
+                return FEED_BUSY
+            # the snapshot of the current transaction predates the lock, the previous run might have moved on since
+            commit(self.env)
+            checkpoints = self.env["twikey.feed.checkpoint"]
+            position = checkpoints.get_position(company, "invoice")
+            checkpoints.start_run(company, "invoice")
+            try:
+                _logger.debug(f"Fetching Twikey updates from {position}")
+                twikey_client = self.env["ir.config_parameter"].get_twikey_client(company=company)
+                if twikey_client:
+                    prefetch = int(self.env["ir.config_parameter"].sudo().get_param("twikey.feed_prefetch", 1))
+                    # decode the (large) pages while they are received, needs ijson
+                    stream = self.env["ir.config_parameter"].sudo().get_param("twikey.feed_stream", "False") == "True"
+                    invoice_feed = OdooInvoiceFeed(self.env, company)
+                    pages = twikey_client.invoice.pages(position, "meta", "lastpayment", prefetch=prefetch, stream=stream)
+                    for count, page in enumerate(pages, 1):
+                        invoice_feed.start(page.position, len(page.items))
+                        if invoice_feed.invoices(page.items):
+                            _logger.debug("Error while handing invoice, stopping")
+                            break
+                        invoice_feed.done(page.position)
+                        if (max_pages and count >= max_pages) or (budget and budget.expired()):
+                            more = True
+                            break
+            except TwikeyError as e:
+                if e.error_code != "err_call_in_progress":  # ignore parallel calls
+                    errmsg = "Exception raised while fetching updates:\n%s" % (e)
+                    self.env['mail.channel'].search([('name', '=', 'twikey')]).message_post(subject="Invoices",body=errmsg,)
+            checkpoints.end_run(company, "invoice")
+            commit(self.env)
+        return more
 
     def update_twikey_state(self, state):
-        try:
-            _logger.debug("Updating Twikey of %s to %s" % (self, state))
-            twikey_client = self.env["ir.config_parameter"].sudo().get_twikey_client(company=self.env.company)
-            if twikey_client:
-                twikey_client.invoice.update(self.twikey_invoice_identifier, {"status": state})
-        except TwikeyError as ue:
-            errmsg = "Error while updating invoice in Twikey: %s" % ue
-            _logger.error(errmsg)
-            self.env['mail.channel'].search([('name', '=', 'twikey')]).message_post(subject="Invoices", body=errmsg, )
+        """ Queue the new state for Twikey, it is sent once the transaction is committed """
+        for move in self:
+            _logger.debug("Updating Twikey of %s to %s" % (move, state))
+            if move.company_id.twikey_api_key:
+                self.env["twikey.outbox"].enqueue(move.company_id, "invoice_update", move.twikey_invoice_identifier,
+                                                  {"status": state})
 
     @api.model_create_multi
     def create(self, vals_list):
@@ -248,6 +498,14 @@ class AccountInvoice(models.Model):
         if "update_feed" in self._context:
             return res
 
+        # posting writes the state too
+        if values.get(F_SEND_TO_TWIKEY) or values.get("state") == "posted":
+            to_be_send = self.filtered(
+                lambda move: move.send_to_twikey and not move.twikey_invoice_identifier and move.state == "posted"
+                and move.company_id.twikey_api_key
+            )
+            self.env["twikey.invoice.queue"].sudo().enqueue(to_be_send)
+
         for record in self:
             if record.twikey_invoice_identifier and values.get("state"):
                 if values.get("state") == "paid":
@@ -288,16 +546,115 @@ class AccountInvoice(models.Model):
             record.id_and_link_html = f'<a href="{record.twikey_url}" target="twikey">{record.twikey_invoice_identifier}</a>'
 
 class OdooInvoiceFeed(InvoiceFeed):
-    def __init__(self, env, company):
+    def __init__(self, env, company, dead_letters=True):
         self.env = env
         self.company = company
+        # the invoices of all companies sharing the Twikey account are in the feed
+        self.companies = company._twikey_account_companies()
+        self.page_size = 0
+        # park failing items instead of stopping the feed
+        self.dead_letters = dead_letters
+        self._parked = None
         self.channel = env['mail.channel'].search([('name', '=', 'twikey')])
         self.transaction = self.env['payment.transaction']
         self.account_move = self.env["account.move"]
+        self._provider = None
+        self._company_providers = {}
+        # records referenced by the current page, see prefetch
+        self.prefetched = False
+        self.moves = {}
+        self.tokens = {}
+        self.transactions = {}
 
     def start(self, position, number_of_invoices):
-        _logger.info(f"Got new {number_of_invoices} invoice update(s) from start={position}")
-        self.company.update({"invoice_feed_pos": position})
+        _logger.info(f"Got new {number_of_invoices} invoice update(s) till position={position}")
+        self.page_size = number_of_invoices
+
+    def done(self, position):
+        """ Page was fully applied, store its position and commit both together """
+        self.env["twikey.feed.checkpoint"].advance(self.company, "invoice", position, self.page_size)
+        commit(self.env)
+
+    @property
+    def provider(self):
+        """ Twikey provider, looked up once per feed run """
+        if self._provider is None:
+            self._provider = self.env['payment.provider'].search([('code', '=', 'twikey')])[0]
+        return self._provider
+
+    def provider_for(self, company):
+        """ Twikey provider of the company the invoice belongs to, the first one if it has none """
+        if company.id not in self._company_providers:
+            provider = self.env['payment.provider'].search([('code', '=', 'twikey'), ('company_id', '=', company.id)], limit=1)
+            self._company_providers[company.id] = provider or self.provider
+        return self._company_providers[company.id]
+
+    @staticmethod
+    def last_payment_of(twikey_invoice):
+        if "lastpayment" in twikey_invoice and len(twikey_invoice["lastpayment"]) > 0:
+            return twikey_invoice.get("lastpayment")[0]
+        return False
+
+    def prefetch(self, twikey_invoices):
+        """ Load the moves, tokens and transactions referenced by a page of the feed with a single query per model """
+        move_ids = set()
+        mandate_numbers = set()
+        references = set()
+        for twikey_invoice in twikey_invoices:
+            ref_id = twikey_invoice.get("ref")
+            if ref_id and ref_id.isnumeric():
+                move_ids.add(int(ref_id))
+            last_payment = self.last_payment_of(twikey_invoice)
+            if last_payment and "mndtId" in last_payment:
+                mandate_numbers.add(last_payment["mndtId"])
+            if twikey_invoice.get("id"):
+                references.add(twikey_invoice.get("id"))
+
+        self.moves = {move.id: move for move in self.account_move.browse(list(move_ids)).exists()
+                      if move.company_id in self.companies}
+        self.tokens = {}
+        if mandate_numbers:
+            for token in self.env['payment.token'].search([('provider_code', '=', 'twikey'),
+                                                          ('provider_ref', 'in', list(mandate_numbers))]):
+                self.tokens.setdefault(token.provider_ref, token)
+        self.transactions = dict.fromkeys(references, self.transaction)
+        if references:
+            for tx in self.transaction.search([("provider_reference", "in", list(references))]):
+                self.transactions[tx.provider_reference] = self.transactions.get(tx.provider_reference, self.transaction) | tx
+        self.prefetched = True
+
+    def invoices(self, twikey_invoices):
+        """
+        Handle a full page of the feed using prefetched records
+        :return: the first error stopping the feed or False
+        """
+        self.prefetch(twikey_invoices)
+        try:
+            for twikey_invoice in twikey_invoices:
+                _logger.debug("Feed handling : %s" % twikey_invoice)
+                error = self.invoice(twikey_invoice)
+                if error:
+                    return error
+            return False
+        finally:
+            self.prefetched = False
+
+    def find_move(self, move_id):
+        if self.prefetched:
+            return self.moves.get(move_id, self.account_move)
+        # ids in ref are only meaningful for the companies of this Twikey account
+        return self.account_move.browse(move_id).exists().filtered(lambda move: move.company_id in self.companies)
+
+    def find_token(self, mandate_number):
+        if self.prefetched:
+            return self.tokens.get(mandate_number, False)
+        search_mandate = [('provider_code', '=', self.provider.code), ('provider_ref', '=', mandate_number)]
+        return self.env['payment.token'].search(search_mandate, limit=1)
+
+    def find_transactions(self, reference):
+        if self.prefetched and reference in self.transactions:
+            return self.transactions[reference]
+        return self.transaction.search([('provider_reference', '=', reference)])
 
     def get_payment_description(self, last_payment):
         twikey_payment_method = last_payment.get("method")  # sdd/rcc/paylink/reporting/manual
@@ -319,107 +676,141 @@ class OdooInvoiceFeed(InvoiceFeed):
         return payment_description
 
     def get_or_create_payment_transaction(self, txdict):
-        tx = self.transaction.search([("provider_reference", "=", txdict['provider_reference'])], limit=1)
+        tx = self.find_transactions(txdict['provider_reference'])[:1]
         if tx:
             return tx
-        return self.transaction.create(txdict)
+        return self.remember_transaction(self.transaction.create(txdict))
+
+    def remember_transaction(self, tx):
+        """ Keep transactions created while handling a page findable for the rest of the page """
+        if self.prefetched:
+            self.transactions[tx.provider_reference] = self.transactions.get(tx.provider_reference, self.transaction) | tx
+        return tx
+
+    @property
+    def parked(self):
+        """ References of the invoices with a pending dead letter, looked up once per feed run """
+        if self._parked is None:
+            self._parked = self.env["twikey.feed.dead.letter"].pending_references(self.company, "invoice")
+        return self._parked
+
+    @staticmethod
+    def reference_of(twikey_invoice):
+        return twikey_invoice.get("number") or twikey_invoice.get("id")
 
     def invoice(self, twikey_invoice):
-        id = twikey_invoice.get("id")
         ref_id = twikey_invoice.get("ref")
-        new_state = twikey_invoice["state"]
-        last_payment = False
-        if "lastpayment" in twikey_invoice and len(twikey_invoice["lastpayment"]) > 0:
-            last_payment = twikey_invoice.get("lastpayment")[0]
-
+        if self.dead_letters and self.reference_of(twikey_invoice) in self.parked:
+            # applying it would overtake the parked older update, so it waits behind it
+            return self.park(twikey_invoice, "Waiting for an earlier update of this invoice")
         try:
-            if ref_id and ref_id.isnumeric():
-                invoice_id = self.account_move.browse(int(ref_id))
-                if invoice_id.exists():
-                    _logger.info("Processing invoice: " + str(twikey_invoice))
-                    invoice_id.twikey_invoice_state = new_state
-                    if new_state == "PAID":
-                        if last_payment:
-                            payment_description = self.get_payment_description(last_payment)
-
-                            invoice_id.message_post(body="Incoming twikey payment via " + payment_description)
-                            provider = self.env['payment.provider'].search([('code', '=', 'twikey')])[0]
-                            token_id = False
-                            if "mndtId" in last_payment:
-                                search_mandate = [('provider_code', '=', provider.code),
-                                       ('provider_ref', '=', last_payment["mndtId"])]
-                                token_id = self.env['payment.token'].search(search_mandate,limit=1)
-                            tx = self.get_or_create_payment_transaction({
-                                'amount': twikey_invoice["amount"],
-                                'currency_id': invoice_id.currency_id.id,
-                                'provider_id': provider.id,
-                                'token_id': token_id.id if token_id else False,
-                                'reference': twikey_invoice["remittance"],
-                                'provider_reference': id,
-                                'operation': "offline",
-                                'partner_id': invoice_id.partner_id.id,
-                            })
-                            tx.invoice_ids = [Command.set(invoice_id.ids)]
-                            tx._set_done(payment_description)
-                            tx._reconcile_after_done()
-                            tx._finalize_post_processing()
-                        else:
-                            invoice_id.message_post(body=f"Unable to register payment as no last payment was found for payment_method={ref_id}")
-                    elif new_state in ["BOOKED", "EXPIRED"]:
-                        # Getting here means either a regular expiry or a reversal
-                        if last_payment:
-                            provider_reference = last_payment["e2e"]
-                            tx = self.transaction.search([('provider_reference','=',id)])
-                            if tx:
-                                errorcode = "Failed with errorcode={}".format(last_payment["rc"])
-                                tx._set_error(errorcode)
-                                refund = tx._create_refund_transaction(amount_to_refund= tx.amount,
-                                   provider_reference=id,
-                                   invoice_ids = invoice_id.ids
-                                )
-                                # tx._set_error(errorcode) wont work as done can't be reverted
-                                refund._set_done(errorcode)
-                                refund._reconcile_after_done()
-                                refund._finalize_post_processing()
-                            else:
-                                _logger.warning(f"payment.transaction with reference={provider_reference} not found")
-                                invoice_id.message_post(body=f"payment.transaction with reference={provider_reference} not found")
-                        else:
-                            invoice_id.message_post(body=f"Unable to unregister payment as no last payment was found for payment_method={ref_id}")
-                else:
-                    _logger.debug(f"No invoice found with id={ref_id}")
-            else:
-                if last_payment:
-                    payment_description = self.get_payment_description(last_payment)
-                    tx = self.transaction.search([("provider_reference","=",id)],limit=1)
-                    if tx:
-                        if new_state == "PAID":
-                            tx._set_done(payment_description)
-                            tx._reconcile_after_done()
-                            tx._finalize_post_processing()
-                        elif new_state in ["BOOKED", "EXPIRED"]:
-                            errorcode = "Failed with errorcode={}".format(last_payment["rc"])
-                            tx._set_error(errorcode)
-                            refund = tx._create_refund_transaction(provider_reference=id)
-                            refund._set_done(errorcode)
-                            refund._reconcile_after_done()
-                            refund._finalize_post_processing()
-                    else:
-                        _logger.warning(f"Invalid invoice-ref={ref_id} ignoring")
+            # an item failing never leaves half of its changes behind
+            with self.env.cr.savepoint():
+                self.apply_invoice(twikey_invoice)
         except TwikeyError as te:
-            self.env.cr.rollback()
+            self.transactions = {}
             errmsg = "Error while updating invoices :\n%s" % (te)
             self.channel.message_post(subject="Twikey problem while updating invoices",body=errmsg,message_type="comment")
             _logger.error("Error while updating invoices from Twikey: %s" % te)
-            return te
+            return self.park(twikey_invoice, te)
         except UserError as ue:
-            errmsg = "Skipping error while handing invoice=%s :\n%s" % (ref_id,ue)
+            # transactions created by this item were rolled back with its savepoint
+            self.transactions = {}
+            errmsg = "Error while handing invoice=%s :\n%s" % (ref_id,ue)
             self.channel.message_post(subject="Odoo problem while updating invoices",body=errmsg,message_type="comment")
-            _logger.exception("Skipping error while handling invoice with number=%s:\n%s", twikey_invoice.get("number"), ue)
-            return False
+            _logger.exception("Error while handling invoice with number=%s:\n%s", twikey_invoice.get("number"), ue)
+            return self.park(twikey_invoice, ue)
         except Exception as ge:
-            self.env.cr.rollback()
+            self.transactions = {}
             errmsg = "Error while handing invoice=%s :\n%s" % (ref_id,ge)
             self.channel.message_post(subject="General problem while updating invoices",body=errmsg,message_type="comment")
             _logger.exception("Error while handling invoice with number=%s:\n%s", twikey_invoice.get("number"), ge)
-            return ge
+            return self.park(twikey_invoice, ge)
+
+    def park(self, twikey_invoice, error):
+        """ Move the failing item to the dead letters so the feed continues, or return the error to stop """
+        if not self.dead_letters:
+            return error
+        reference = self.reference_of(twikey_invoice)
+        self.env["twikey.feed.dead.letter"].park(self.company, "invoice", twikey_invoice, error, reference)
+        if reference:
+            self.parked.add(reference)
+        return False
+
+    def apply_invoice(self, twikey_invoice):
+        id = twikey_invoice.get("id")
+        ref_id = twikey_invoice.get("ref")
+        new_state = twikey_invoice["state"]
+        last_payment = self.last_payment_of(twikey_invoice)
+
+        if ref_id and ref_id.isnumeric():
+            invoice_id = self.find_move(int(ref_id))
+            if invoice_id:
+                _logger.info("Processing invoice: " + str(twikey_invoice))
+                invoice_id.twikey_invoice_state = new_state
+                if new_state == "PAID":
+                    if last_payment:
+                        payment_description = self.get_payment_description(last_payment)
+
+                        invoice_id.message_post(body="Incoming twikey payment via " + payment_description)
+                        provider = self.provider_for(invoice_id.company_id)
+                        token_id = False
+                        if "mndtId" in last_payment:
+                            token_id = self.find_token(last_payment["mndtId"])
+                        tx = self.get_or_create_payment_transaction({
+                            'amount': twikey_invoice["amount"],
+                            'currency_id': invoice_id.currency_id.id,
+                            'provider_id': provider.id,
+                            'token_id': token_id.id if token_id else False,
+                            'reference': twikey_invoice["remittance"],
+                            'provider_reference': id,
+                            'operation': "offline",
+                            'partner_id': invoice_id.partner_id.id,
+                        })
+                        tx.invoice_ids = [Command.set(invoice_id.ids)]
+                        tx._set_done(payment_description)
+                        tx._reconcile_after_done()
+                        tx._finalize_post_processing()
+                    else:
+                        invoice_id.message_post(body=f"Unable to register payment as no last payment was found for payment_method={ref_id}")
+                elif new_state in ["BOOKED", "EXPIRED"]:
+                    # Getting here means either a regular expiry or a reversal
+                    if last_payment:
+                        provider_reference = last_payment["e2e"]
+                        tx = self.find_transactions(id)
+                        if tx:
+                            errorcode = "Failed with errorcode={}".format(last_payment["rc"])
+                            tx._set_error(errorcode)
+                            refund = self.remember_transaction(tx._create_refund_transaction(amount_to_refund= tx.amount,
+                               provider_reference=id,
+                               invoice_ids = invoice_id.ids
+                            ))
+                            # tx._set_error(errorcode) wont work as done can't be reverted
+                            refund._set_done(errorcode)
+                            refund._reconcile_after_done()
+                            refund._finalize_post_processing()
+                        else:
+                            _logger.warning(f"payment.transaction with reference={provider_reference} not found")
+                            invoice_id.message_post(body=f"payment.transaction with reference={provider_reference} not found")
+                    else:
+                        invoice_id.message_post(body=f"Unable to unregister payment as no last payment was found for payment_method={ref_id}")
+            else:
+                _logger.debug(f"No invoice found with id={ref_id}")
+        else:
+            if last_payment:
+                payment_description = self.get_payment_description(last_payment)
+                tx = self.find_transactions(id)[:1]
+                if tx:
+                    if new_state == "PAID":
+                        tx._set_done(payment_description)
+                        tx._reconcile_after_done()
+                        tx._finalize_post_processing()
+                    elif new_state in ["BOOKED", "EXPIRED"]:
+                        errorcode = "Failed with errorcode={}".format(last_payment["rc"])
+                        tx._set_error(errorcode)
+                        refund = self.remember_transaction(tx._create_refund_transaction(provider_reference=id))
+                        refund._set_done(errorcode)
+                        refund._reconcile_after_done()
+                        refund._finalize_post_processing()
+                else:
+                    _logger.warning(f"Invalid invoice-ref={ref_id} ignoring")
@@ -1,10 +1,16 @@
 from odoo import _, exceptions, models, tools, service
 
 import logging
+import threading
 from .. import twikey
+from .twikey_session_token import OdooTokenStore
 
 _logger = logging.getLogger(__name__)
 
+# last client built per (database, company), closed when the ormcache is cleared and a new one replaces it
+_live_clients = {}
+_live_clients_lock = threading.Lock()
+
 class IrConfigParameter(models.Model):
 
     _inherit = "ir.config_parameter"
@@ -23,7 +29,21 @@ class IrConfigParameter(models.Model):
             server_ver = service.common.exp_version()['server_version']
             module = self.env['ir.module.module'].sudo().search([('name', '=', 'payment_twikey')])
             twikey_ver = module and module.installed_version or 'unsupported'
-            return twikey.client.TwikeyClient(api_key, base_url, f'odoo/{server_ver} twikey/{twikey_ver}')
+            # one client (and so one pool of keep-alive connections) per company
+            pool_size = int(self.sudo().get_param("twikey.pool_size", 10))
+            # calls per second, shared by everything using this client (0 to only honour Twikey's Retry-After)
+            rate_limit = float(self.sudo().get_param("twikey.rate_limit", 10))
+            client = twikey.client.TwikeyClient(api_key, base_url, f'odoo/{server_ver} twikey/{twikey_ver}', pool_size=pool_size,
+                                                token_store=OdooTokenStore(self.env.registry, company.id),
+                                                rate_limit=rate_limit)
+            with _live_clients_lock:
+                previous = _live_clients.get((self.env.cr.dbname, company.id))
+                _live_clients[(self.env.cr.dbname, company.id)] = client
+            if previous:
+                # release its pooled connections now instead of whenever it is garbage collected, a call still
+                # running on it simply opens a new connection
+                previous.close()
+            return client
         else:
             _logger.warning(f"No Twikey configuration for found in company {company}")
             raise exceptions.UserError(_("No company was set to get the Twikey credentials!"))
@@ -1,5 +1,15 @@
+import logging
+from datetime import datetime
+
 from odoo import fields, models
 
+from ..utils import FEED_BUSY
+
+_logger = logging.getLogger(__name__)
+
+# helpers of every company cron declared in schedulers.xml
+MAX_CRON_HELPERS = 3
+
 
 class ResCompany(models.Model):
     _inherit = "res.company"
@@ -12,5 +22,71 @@ class ResCompany(models.Model):
     twikey_send_invoice = fields.Boolean()
     twikey_include_purchase = fields.Boolean()
 
+    # no longer written, the positions moved to twikey.feed.checkpoint
     mandate_feed_pos = fields.Integer(readonly=True)
     invoice_feed_pos = fields.Integer(readonly=True)
+
+    def _twikey_account_companies(self):
+        """ Companies sharing the Twikey account of this company, the first one pulls the feeds for all of them """
+        self.ensure_one()
+        if not self.twikey_api_key or not self.twikey_base_url:
+            return self
+        return self.sudo().search([
+            ("twikey_api_key", "=", self.twikey_api_key), ("twikey_base_url", "=", self.twikey_base_url)
+        ], order="id")
+
+    def _twikey_companies(self, feed_type=False):
+        """
+        Companies configured for Twikey, those whose feed_type ran least recently first.
+        For a feed, only the first company of every Twikey account is returned as it pulls the feed for all of them.
+        """
+        companies = self.sudo().search([("twikey_api_key", "!=", False), ("twikey_base_url", "!=", False)], order="id")
+        if feed_type:
+            leaders = {}
+            for company in companies:
+                leaders.setdefault((company.twikey_api_key, company.twikey_base_url), company)
+            companies = self.sudo().browse([company.id for company in leaders.values()])
+            checkpoints = self.env["twikey.feed.checkpoint"].sudo().search([
+                ("feed_type", "=", feed_type), ("company_id", "in", companies.ids)
+            ])
+            last_run = {checkpoint.company_id.id: checkpoint.run_start for checkpoint in checkpoints}
+            companies = companies.sorted(lambda company: last_run.get(company.id) or datetime.min)
+        return companies
+
+    def _twikey_start_helpers(self, xmlid):
+        """
+        Trigger the first twikey.cron_workers - 1 helpers of the cron (xmlid_helper_<n>, see schedulers.xml). Odoo
+        never runs a cron twice at once, with the helpers several cron workers take companies in parallel, every
+        one of them skipping the companies locked by the others.
+        """
+        workers = min(self._twikey_cron_workers(), MAX_CRON_HELPERS + 1)
+        if workers <= 1 or len(self._twikey_companies()) <= 1:
+            return
+        for number in range(1, workers):
+            helper = self.env.ref(f"{xmlid}_helper_{number}", raise_if_not_found=False)
+            if helper:
+                helper.sudo()._trigger()
+
+    def _twikey_cron_workers(self):
+        return int(self.env["ir.config_parameter"].sudo().get_param("twikey.cron_workers", 1))
+
+    def _twikey_run_for_companies(self, feed_type, run, budget=None):
+        """
+        Call run(company) for every company configured for Twikey. A company busy in another worker is skipped
+        by the lock taken in run, a failing company doesn't stop the others.
+        :param budget: TimeBudget, companies not handled when it is used up are left for the next run
+        :return: True when any of the runs reported more work to be done
+        """
+        more = False
+        for company in self._twikey_companies(feed_type):
+            if budget and budget.expired():
+                _logger.info(f"Twikey {feed_type or 'invoice sender'} out of time, continuing with {company.name} next run")
+                return True
+            try:
+                result = run(company)
+                # a feed busy in another worker is caught up by that worker
+                more = more or (bool(result) and result != FEED_BUSY)
+            except Exception:
+                self.env.cr.rollback()
+                _logger.exception(f"Twikey {feed_type or 'invoice sender'} failed for {company.name}")
+        return more
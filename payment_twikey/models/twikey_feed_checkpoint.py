@@ -0,0 +1,91 @@
+import logging
+
+from odoo import api, fields, models
+
+from ..utils import feed_lock_stats
+
+_logger = logging.getLogger(__name__)
+
+FEED_TYPES = [
+    ("invoice", "Invoice"),
+    ("mandate", "Mandate"),
+    ("transaction", "Transaction"),
+    ("refund", "Refund"),
+    ("paylink", "Paylink"),
+]
+
+
+class TwikeyFeedCheckpoint(models.Model):
+    """
+    Position of every feed per company. Kept out of res.company as it is written for every page, which would
+    otherwise update a hot row and clear the caches of the company (and the Twikey clients cached with them).
+    Written with plain sql for the same reason.
+    """
+    _name = "twikey.feed.checkpoint"
+    _description = "Position of a Twikey feed"
+    _order = "company_id, feed_type"
+
+    _sql_constraints = [("company_feed_unique", "unique(company_id, feed_type)", "Only one checkpoint per company and feed!")]
+
+    company_id = fields.Many2one("res.company", required=True, readonly=True, ondelete="cascade", index=True)
+    feed_type = fields.Selection(FEED_TYPES, required=True, readonly=True)
+    position = fields.Integer(readonly=True, help="Last position fully applied")
+    item_count = fields.Integer(readonly=True, help="Items applied during the last run")
+    run_start = fields.Datetime(readonly=True)
+    run_end = fields.Datetime(readonly=True)
+    duration = fields.Float(readonly=True, help="Duration of the last run in seconds")
+
+    def init(self):
+        # positions used to be kept on the company
+        self.env.cr.execute("""
+            INSERT INTO twikey_feed_checkpoint (company_id, feed_type, position, item_count)
+                 SELECT id, 'invoice', invoice_feed_pos, 0 FROM res_company WHERE invoice_feed_pos > 0
+                  UNION ALL
+                 SELECT id, 'mandate', mandate_feed_pos, 0 FROM res_company WHERE mandate_feed_pos > 0
+            ON CONFLICT (company_id, feed_type) DO NOTHING
+        """)
+
+    @api.model
+    def get_position(self, company, feed_type):
+        self.env.cr.execute("SELECT position FROM twikey_feed_checkpoint WHERE company_id = %s AND feed_type = %s",
+                            [company.id, feed_type])
+        row = self.env.cr.fetchone()
+        return row[0] if row and row[0] else False
+
+    @api.model
+    def start_run(self, company, feed_type):
+        self.env.cr.execute("""
+            INSERT INTO twikey_feed_checkpoint (company_id, feed_type, position, item_count, run_start, run_end, duration)
+                 VALUES (%s, %s, 0, 0, clock_timestamp() at time zone 'utc', NULL, NULL)
+            ON CONFLICT (company_id, feed_type) DO UPDATE
+                    SET item_count = 0, run_start = EXCLUDED.run_start, run_end = NULL, duration = NULL
+        """, [company.id, feed_type])
+        self.invalidate_model()
+
+    @api.model
+    def advance(self, company, feed_type, position, item_count):
+        """ Store the position of a page fully applied, to be committed together with the page """
+        self.env.cr.execute("""
+            UPDATE twikey_feed_checkpoint
+               SET position = %s, item_count = item_count + %s
+             WHERE company_id = %s AND feed_type = %s
+        """, [position, item_count, company.id, feed_type])
+        self.invalidate_model()
+
+    @api.model
+    def end_run(self, company, feed_type):
+        self.env.cr.execute("""
+            UPDATE twikey_feed_checkpoint
+               SET run_end = clock_timestamp() at time zone 'utc',
+                   duration = EXTRACT(EPOCH FROM (clock_timestamp() at time zone 'utc') - run_start)
+             WHERE company_id = %s AND feed_type = %s
+         RETURNING position, item_count, duration
+        """, [company.id, feed_type])
+        row = self.env.cr.fetchone()
+        self.invalidate_model()
+        if row:
+            _logger.info(f"Twikey {feed_type} feed of {company.name} at position={row[0]} after {row[1]} item(s) in {row[2] or 0:.1f}s")
+        stats = feed_lock_stats().get(feed_type)
+        if stats:
+            _logger.info(f"Twikey {feed_type} feed lock in this worker: {stats['acquired']} run(s), {stats['skipped']} skipped "
+                         f"as busy, waited {stats['wait']:.2f}s (max {stats['max_wait']:.2f}s), held {stats['held']:.1f}s")
@@ -0,0 +1,131 @@
+import json
+import logging
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+from ..utils import commit, TimeBudget
+from .account_move import OdooInvoiceFeed
+from .twikey_mandate_details import OdooDocumentFeed
+
+_logger = logging.getLogger(__name__)
+
+
+class TwikeyFeedDeadLetter(models.Model):
+    _name = "twikey.feed.dead.letter"
+    _description = "Twikey feed item that could not be handled"
+    _order = "next_retry, id"
+    _rec_name = "reference"
+
+    company_id = fields.Many2one("res.company", required=True, readonly=True, ondelete="cascade")
+    feed = fields.Selection([("invoice", "Invoice"), ("mandate", "Mandate")], required=True, readonly=True)
+    reference = fields.Char(readonly=True, index=True)
+    payload = fields.Text(readonly=True, help="Item as received from the Twikey feed")
+    error = fields.Text(readonly=True)
+    retry_count = fields.Integer(readonly=True)
+    next_retry = fields.Datetime(readonly=True, index=True)
+    state = fields.Selection(
+        [
+            ("pending", "Pending"),
+            ("done", "Done"),
+            ("failed", "Failed"),
+        ],
+        default="pending",
+        required=True,
+        readonly=True,
+    )
+
+    @api.model
+    def park(self, company, feed, item, error, reference=False):
+        """ Keep a failing feed item aside so the feed can continue """
+        _logger.warning(f"Parking {feed} feed item {reference} of {company.name}: {error}")
+        return self.sudo().create({
+            "company_id": company.id,
+            "feed": feed,
+            "reference": reference,
+            "payload": json.dumps(item),
+            "error": str(error),
+            "next_retry": fields.Datetime.now() + self._backoff(0),
+        })
+
+    @api.model
+    def pending_references(self, company, feed):
+        """ References with a pending letter, later items for these are parked behind it to keep their order """
+        self.env.cr.execute("""
+            SELECT DISTINCT reference FROM twikey_feed_dead_letter
+             WHERE company_id = %s AND feed = %s AND state = 'pending' AND reference IS NOT NULL
+        """, [company.id, feed])
+        return {row[0] for row in self.env.cr.fetchall()}
+
+    def _waiting_for_older(self):
+        """ An older letter of the same item is still pending, it has to be replayed first """
+        self.ensure_one()
+        if not self.reference:
+            return False
+        return bool(self.search_count([
+            ("company_id", "=", self.company_id.id),
+            ("feed", "=", self.feed),
+            ("reference", "=", self.reference),
+            ("state", "=", "pending"),
+            ("id", "<", self.id),
+        ]))
+
+    @api.model
+    def _backoff(self, retry_count):
+        base = int(self.env["ir.config_parameter"].sudo().get_param("twikey.dead_letter_backoff", 5))
+        return timedelta(minutes=min(base * 2 ** retry_count, 24 * 60))
+
+    def action_retry(self):
+        for letter in self.sorted("id"):
+            letter.replay()
+
+    def replay(self):
+        """ Hand the item to the feed again, reschedule with backoff when it fails again """
+        self.ensure_one()
+        if self._waiting_for_older():
+            # replaying it now would apply it before the older update of the same invoice or mandate
+            return False
+        error = self._replay()
+        if not error:
+            self.write({"state": "done", "error": False})
+            return True
+        max_retries = int(self.env["ir.config_parameter"].sudo().get_param("twikey.dead_letter_max_retries", 10))
+        retry_count = self.retry_count + 1
+        self.write({
+            "error": str(error),
+            "retry_count": retry_count,
+            "next_retry": fields.Datetime.now() + self._backoff(retry_count),
+            "state": "failed" if retry_count >= max_retries else "pending",
+        })
+        return False
+
+    def _replay(self):
+        item = json.loads(self.payload)
+        env = self.env(context=dict(self.env.context, allowed_company_ids=self.company_id.ids))
+        if self.feed == "invoice":
+            return OdooInvoiceFeed(env, self.company_id, dead_letters=False).invoice(item)
+        twikey_client = env["ir.config_parameter"].get_twikey_client(company=self.company_id)
+        if not twikey_client:
+            return "Twikey not configured"
+        return twikey_client.document.dispatch(OdooDocumentFeed(env, self.company_id, dead_letters=False), item)
+
+    @api.model
+    def _cron_retry(self, limit=100):
+        budget = TimeBudget.for_cron(self.env)
+        # the letters of an invoice or mandate are replayed one after the other, oldest first
+        self.env.cr.execute("""
+            SELECT id FROM twikey_feed_dead_letter l
+             WHERE state = 'pending' AND next_retry <= (now() at time zone 'utc')
+               AND NOT EXISTS (SELECT 1 FROM twikey_feed_dead_letter p
+                                WHERE p.state = 'pending' AND p.company_id = l.company_id AND p.feed = l.feed
+                                  AND p.reference = l.reference AND p.id < l.id)
+             ORDER BY next_retry, id
+             LIMIT %s
+        """, [limit])
+        letters = self.browse([row[0] for row in self.env.cr.fetchall()])
+        for letter in letters:
+            if budget.expired():
+                self.env.ref("payment_twikey.twikey_retry_dead_letters")._trigger()
+                break
+            letter.replay()
+            commit(self.env)
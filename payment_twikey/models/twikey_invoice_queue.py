@@ -0,0 +1,85 @@
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+
+class TwikeyInvoiceQueue(models.Model):
+    """
+    Invoices waiting to be sent to Twikey. Filled when an invoice is posted or marked to be sent, so the sender
+    only has to read this (small) table instead of looking through all account moves.
+    """
+    _name = "twikey.invoice.queue"
+    _description = "Invoice waiting to be sent to Twikey"
+    # invoices that failed before come after the new ones
+    _order = "attempts, id"
+
+    _sql_constraints = [("move_unique", "unique(move_id)", "An invoice is queued only once!")]
+
+    move_id = fields.Many2one("account.move", required=True, readonly=True, ondelete="cascade")
+    company_id = fields.Many2one("res.company", required=True, readonly=True, ondelete="cascade", index=True)
+    attempts = fields.Integer(readonly=True, help="Failed attempts to send the invoice")
+    next_attempt = fields.Datetime(readonly=True, index=True)
+
+    def init(self):
+        # invoices that were waiting for the sender before the queue existed
+        self.env.cr.execute("""
+            INSERT INTO twikey_invoice_queue (move_id, company_id, attempts, next_attempt)
+                 SELECT m.id, m.company_id, 0, now() at time zone 'utc'
+                   FROM account_move m JOIN res_company c ON c.id = m.company_id
+                  WHERE m.send_to_twikey AND m.twikey_invoice_identifier IS NULL AND m.state = 'posted'
+                    AND c.twikey_api_key IS NOT NULL
+            ON CONFLICT (move_id) DO NOTHING
+        """)
+
+    @api.model
+    def enqueue(self, moves):
+        """ Queue the moves and have the sender pick them up a few seconds after the commit """
+        # nothing would ever send the invoices of companies without Twikey
+        moves = moves.filtered(lambda move: move.company_id.twikey_api_key)
+        if not moves:
+            return
+        # queued again by the user (eg. after fixing the invoice), so try straight away
+        self.env.cr.execute("""
+            INSERT INTO twikey_invoice_queue (move_id, company_id, attempts, next_attempt)
+                 SELECT id, company_id, 0, now() at time zone 'utc' FROM account_move WHERE id IN %s
+            ON CONFLICT (move_id) DO UPDATE SET attempts = 0, next_attempt = EXCLUDED.next_attempt
+        """, [tuple(moves.ids)])
+        # a single trigger per transaction, waiting a bit so invoices posted together are sent in one batch
+        if not self.env.cr.precommit.data.get("twikey.invoice_queue.triggered"):
+            self.env.cr.precommit.data["twikey.invoice_queue.triggered"] = True
+            delay = int(self.env["ir.config_parameter"].sudo().get_param("twikey.send_delay", 5))
+            self.env.ref("payment_twikey.twikey_invoice_sender").sudo()._trigger(
+                at=fields.Datetime.now() + timedelta(seconds=delay)
+            )
+
+    @api.model
+    def pending_moves(self, company, limit=None):
+        """
+        Queued moves of the company due to be sent, new ones first, forgetting the ones that no longer need to be.
+        Moves that failed before only come back once their backoff passed.
+        """
+        queued = self.search([
+            ("company_id", "=", company.id),
+            "|", ("next_attempt", "=", False), ("next_attempt", "<=", fields.Datetime.now()),
+        ], limit=limit)
+        moves = queued.move_id.filtered(
+            lambda move: move.send_to_twikey and not move.twikey_invoice_identifier and move.state == "posted"
+        )
+        (queued - queued.filtered(lambda entry: entry.move_id in moves)).unlink()
+        return moves
+
+    @api.model
+    def processed(self, moves):
+        """ Remove the moves that were sent (or skipped) from the queue, retry the others later with a backoff """
+        queued = self.search([("move_id", "in", moves.ids)])
+        done = queued.filtered(
+            lambda entry: not entry.move_id.send_to_twikey or entry.move_id.twikey_invoice_identifier
+        )
+        done.unlink()
+        base = int(self.env["ir.config_parameter"].sudo().get_param("twikey.send_backoff", 5))
+        for entry in queued - done:
+            attempts = entry.attempts + 1
+            entry.write({
+                "attempts": attempts,
+                "next_attempt": fields.Datetime.now() + timedelta(minutes=min(base * 2 ** attempts, 24 * 60)),
+            })
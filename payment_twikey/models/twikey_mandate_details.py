@@ -1,12 +1,12 @@
 import logging
 
-import requests
-from odoo import _, fields, models
+from odoo import api, fields, models
+from odoo.addons.base.models.res_bank import sanitize_account_number
 from odoo.exceptions import UserError
 
 from ..twikey.client import TwikeyError
 from ..twikey.document import DocumentFeed
-from ..utils import sanitise_iban, field_name_from_attribute
+from ..utils import sanitise_iban, field_name_from_attribute, commit, feed_lock, FEED_BUSY, TimeBudget
 
 _logger = logging.getLogger(__name__)
 
@@ -54,49 +54,87 @@ class TwikeyMandateDetails(models.Model):
         action["res_id"] = wizard.id
         return action
 
-    def update_feed(self, company = None):
+    @api.model
+    def _cron_update_feed(self, helper=0):
+        """ Mandate feed of every company configured for Twikey, the least recently updated first """
+        if not helper:
+            self.env["res.company"]._twikey_start_helpers("payment_twikey.twikey_update_feed")
+        elif helper >= self.env["res.company"]._twikey_cron_workers():
+            # a helper running on its own schedule while fewer workers are asked for
+            return
+        max_pages = int(self.env["ir.config_parameter"].sudo().get_param("twikey.feed_max_pages", 50))
+        budget = TimeBudget.for_cron(self.env)
+        more = self.env["res.company"]._twikey_run_for_companies(
+            "mandate", lambda company: self.with_company(company).update_feed(company, max_pages, budget), budget
+        )
+        if more:
+            self.env.ref("payment_twikey.twikey_update_feed")._trigger()
+
+    def update_feed(self, company = None, max_pages = None, budget = None):
+        """
+        :param max_pages: stop after this many pages so other companies get their turn
+        :param budget: TimeBudget, stop after the page during which it was used up
+        :return: True when stopped because of max_pages or the budget, FEED_BUSY when another worker runs it
+        """
         if not company:
             company = self.env.company
-        try:
-            _logger.debug(f"Fetching Twikey updates from {company.mandate_feed_pos}")
-            twikey_client = self.env["ir.config_parameter"].get_twikey_client(company=company)
-            if twikey_client:
-                twikey_client.document.feed(OdooDocumentFeed(self.env, company), company.mandate_feed_pos)
-        except TwikeyError as e:
-            if e.error_code != "err_call_in_progress":  # ignore parallel calls
-                errmsg = "Exception raised while fetching updates:\n%s" % e
-                self.env['mail.channel'].search([('name', '=', 'twikey')]).message_post(subject="Mandates", body=errmsg)
+        # companies sharing a Twikey account share the feed too
+        company = company._twikey_account_companies()[0]
+        more = False
+        with feed_lock(self.env, company, "mandate") as locked:
+            if not locked:
+                return FEED_BUSY
+            # the snapshot of the current transaction predates the lock, the previous run might have moved on since
+            commit(self.env)
+            checkpoints = self.env["twikey.feed.checkpoint"]
+            position = checkpoints.get_position(company, "mandate")
+            checkpoints.start_run(company, "mandate")
+            try:
+                _logger.debug(f"Fetching Twikey updates from {position}")
+                twikey_client = self.env["ir.config_parameter"].get_twikey_client(company=company)
+                if twikey_client:
+                    prefetch = int(self.env["ir.config_parameter"].sudo().get_param("twikey.feed_prefetch", 1))
+                    stream = self.env["ir.config_parameter"].sudo().get_param("twikey.feed_stream", "False") == "True"
+                    document_feed = OdooDocumentFeed(self.env, company)
+                    pages = twikey_client.document.pages(position, prefetch=prefetch, stream=stream)
+                    for count, page in enumerate(pages, 1):
+                        document_feed.start(page.position, len(page.items))
+                        document_feed.documents(page.items, twikey_client.document)
+                        document_feed.done(page.position)
+                        if (max_pages and count >= max_pages) or (budget and budget.expired()):
+                            more = True
+                            break
+            except TwikeyError as e:
+                if e.error_code != "err_call_in_progress":  # ignore parallel calls
+                    errmsg = "Exception raised while fetching updates:\n%s" % e
+                    self.env['mail.channel'].search([('name', '=', 'twikey')]).message_post(subject="Mandates", body=errmsg)
+            checkpoints.end_run(company, "mandate")
+            commit(self.env)
+        return more
 
     def write(self, values):
         self.ensure_one()
         res = super(TwikeyMandateDetails, self).write(values)
 
-        try:
-            twikey_client = self.env["ir.config_parameter"].get_twikey_client(company=self.env.company)
-            if twikey_client:
-                if not self._context.get("update_feed"):
-                    data = {}
-                    if self.state != "signed":
-                        data["mndtId"] = values.get("reference") if values.get("reference") else self.reference
-                        if "iban" in values:
-                            data["iban"] = values.get("iban") or ""
-                        if "bic" in values:
-                            data["bic"] = values.get("bic")
-                        if "lang" in values:
-                            data["l"] = values.get("lang")
-                        if "email" in values:
-                            data["email"] = values.get("email")
-                        if "mobile" in values:
-                            data["mobile"] = values.get("mobile")
-
-                        try:
-                            if data != {}:
-                                twikey_client.document.update(data)
-                        except (Exception, requests.exceptions.RequestException) as e:
-                            raise UserError(_('Error sending update: %s') % (str(e)))
-            return res
-        except TwikeyError as e:
-            raise UserError from e
+        if self.env.company.twikey_api_key and not self._context.get("update_feed"):
+            data = {}
+            if self.state != "signed":
+                data["mndtId"] = values.get("reference") if values.get("reference") else self.reference
+                if "iban" in values:
+                    data["iban"] = values.get("iban") or ""
+                if "bic" in values:
+                    data["bic"] = values.get("bic")
+                if "lang" in values:
+                    data["l"] = values.get("lang")
+                if "email" in values:
+                    data["email"] = values.get("email")
+                if "mobile" in values:
+                    data["mobile"] = values.get("mobile")
+
+                if data != {}:
+                    # sent once committed
+                    self.env["twikey.outbox"].enqueue(self.env.company, "mandate_update", data["mndtId"], data)
+        return res
 
     def is_signed(self):
         return self.state == 'signed'
@@ -113,15 +151,152 @@ class TwikeyMandateDetails(models.Model):
 
 
 class OdooDocumentFeed(DocumentFeed):
-    def __init__(self, env, company):
+    def __init__(self, env, company, dead_letters=True):
         self.env = env
         self.company = company
+        # mandates of all companies sharing the Twikey account are in the feed
+        self.companies = company._twikey_account_companies()
+        self.page_size = 0
+        # park failing messages instead of only logging them
+        self.dead_letters = dead_letters
+        self.current_message = False
+        self._parked = None
         self.res_country = self.env["res.country"]
         self.res_lang = self.env["res.lang"]
         self.res_partner = self.env["res.partner"]
         self.mandates = self.env["twikey.mandate.details"]
         self.template = self.env["twikey.contract.template"]
         self.paymentprovider = self.env["payment.provider"]
+        self.partner_bank = self.env["res.partner.bank"]
+        self.bank = self.env["res.bank"]
+        self._providers = None
+        # records looked up during this feed run by key, filled per page by prefetch
+        self.countries = {}
+        self.langs = {}
+        self.templates = {}
+        self.mandate_refs = {}
+        self.partners = {}
+        self.bank_accounts = {}
+        self.banks = {}
+
+    @property
+    def providers(self):
+        """ Twikey providers, looked up once per feed run """
+        if self._providers is None:
+            self._providers = self.paymentprovider.search([("code", "=", 'twikey')])
+            # tokens only for the providers of the companies using this Twikey account
+            providers_of_account = self._providers.filtered(lambda provider: provider.company_id in self.companies)
+            if providers_of_account:
+                self._providers = providers_of_account
+        return self._providers
+
+    @staticmethod
+    def _load(cache, model, field, keys):
+        """ Fetch all records of model having field in keys that aren't cached yet with a single query """
+        missing = [key for key in set(keys) if key and key not in cache]
+        if not missing:
+            return
+        for key in missing:
+            cache[key] = model
+        for record in model.search([(field, "in", missing)]):
+            cache[record[field]] = cache.get(record[field], model) | record
+
+    @staticmethod
+    def _find(cache, model, field, key):
+        if not key:
+            return model
+        if key not in cache:
+            cache[key] = model.search([(field, "=", key)])
+        return cache[key]
+
+    def prefetch(self, messages):
+        """
+        Load the countries, languages, profiles, mandates, partners, bank accounts and banks referenced
+        by a page of the feed with one query per model
+        """
+        country_codes, iso_codes, template_ids, references, partner_ids, ibans, bics = [], [], [], [], [], [], []
+        for msg in messages:
+            if "OrgnlMndtId" in msg:
+                references.append(msg["OrgnlMndtId"])
+            doc = msg.get("Mndt")
+            if not doc:
+                continue
+            references.append(doc.get("MndtId"))
+            debtor = doc.get("Dbtr") or {}
+            country_codes.append((debtor.get("PstlAdr") or {}).get("Ctry"))
+            customer_number = (debtor.get("CtctDtls") or {}).get("Othr")
+            if customer_number and str(customer_number).isnumeric():
+                partner_ids.append(int(customer_number))
+            ibans.append(doc.get("DbtrAcct"))
+            bics.append(((doc.get("DbtrAgt") or {}).get("FinInstnId") or {}).get("BICFI"))
+            field_dict = self.splmtr_as_dict(doc)
+            iso_codes.append(field_dict.get("Language"))
+            template_ids.append(self.template_key(field_dict.get("TemplateId")))
+
+        self._load(self.countries, self.res_country, "code", country_codes)
+        self._load(self.langs, self.res_lang, "iso_code", iso_codes)
+        self._load(self.templates, self.template, "template_id_twikey", template_ids)
+        self._load(self.mandate_refs, self.mandates, "reference", references)
+        # keyed on the sanitized number, the one res.partner.bank matches acc_number on
+        self._load(self.bank_accounts, self.partner_bank, "sanitized_acc_number",
+                   [sanitize_account_number(iban) for iban in ibans])
+        self._load(self.banks, self.bank, "bic", bics)
+        new_partner_ids = [partner_id for partner_id in set(partner_ids) if partner_id not in self.partners]
+        for partner in self.res_partner.browse(new_partner_ids).exists():
+            self.partners[partner.id] = partner
+
+    def documents(self, messages, document_api):
+        """ Handle a full page of the feed using the records prefetched for the whole page """
+        self.prefetch(messages)
+        for msg in messages:
+            self.current_message = msg
+            reference = self.reference_of(msg)
+            if self.dead_letters and reference in self.parked:
+                # applying it would overtake the parked older message, so it waits behind it
+                self.park(reference, "Waiting for an earlier message of this mandate")
+                continue
+            document_api.dispatch(self, msg)
+        self.current_message = False
+
+    @property
+    def parked(self):
+        """ Mandate numbers with a pending dead letter, looked up once per feed run """
+        if self._parked is None:
+            self._parked = self.env["twikey.feed.dead.letter"].pending_references(self.company, "mandate")
+        return self._parked
+
+    @staticmethod
+    def reference_of(msg):
+        return msg.get("OrgnlMndtId") or (msg.get("Mndt") or {}).get("MndtId")
+
+    def park(self, reference, error):
+        """ Move the message being handled to the dead letters, or return the error when replaying """
+        if not self.dead_letters or not self.current_message:
+            return error
+        self.env["twikey.feed.dead.letter"].park(self.company, "mandate", self.current_message, error, reference)
+        if reference:
+            self.parked.add(reference)
+        return False
+
+    @staticmethod
+    def template_key(template_id):
+        try:
+            return int(template_id) if template_id else False
+        except ValueError:
+            return False
+
+    def find_mandates(self, reference):
+        return self._find(self.mandate_refs, self.mandates, "reference", reference)
+
+    def remember_mandate(self, mandate):
+        if mandate.reference:
+            self.mandate_refs[mandate.reference] = self.mandate_refs.get(mandate.reference, self.mandates) | mandate
+        return mandate
+
+    def find_partner(self, partner_id):
+        if partner_id not in self.partners:
+            self.partners[partner_id] = self.res_partner.browse(partner_id).exists()
+        return self.partners[partner_id]
 
     @staticmethod
     def splmtr_as_dict(doc):
@@ -142,7 +317,7 @@ class OdooDocumentFeed(DocumentFeed):
             address = address_line.get("AdrLine") if address_line.get("AdrLine") else False
             zip_code = address_line.get("PstCd") if address_line.get("PstCd") else False
             city = address_line.get("TwnNm") if address_line.get("TwnNm") else False
-            country_id = self.res_country.search([("code", "=", address_line.get("Ctry"))])
+            country_id = self._find(self.countries, self.res_country, "code", address_line.get("Ctry"))
 
         return address, zip_code, city, country_id
 
@@ -178,11 +353,11 @@ class OdooDocumentFeed(DocumentFeed):
         field_dict = self.splmtr_as_dict(doc)
         if "Language" in field_dict:
             lang = field_dict["Language"]
-            lang_id = self.res_lang.search([("iso_code", "=", lang)])
+            lang_id = self._find(self.langs, self.res_lang, "iso_code", lang)
 
         if "TemplateId" in field_dict:
             temp_id = field_dict["TemplateId"]
-            template_id = self.template.search([("template_id_twikey", "=", temp_id)], limit=1)
+            template_id = self._find(self.templates, self.template, "template_id_twikey", self.template_key(temp_id))[:1]
 
         address, zip_code, city, country_id = self.prepare_address(debtor)
 
@@ -194,7 +369,7 @@ class OdooDocumentFeed(DocumentFeed):
                 try:
                     lookup_id = int(customer_number)
                     _logger.debug("Got lookup_id %s" % lookup_id)
-                    partner_id = self.res_partner.browse(lookup_id)
+                    partner_id = self.find_partner(lookup_id)
                 except ValueError:
                     _logger.error("Customer had invalid number=%s." % customer_number)
                 except UserError:
@@ -214,9 +389,9 @@ class OdooDocumentFeed(DocumentFeed):
         partner_id = self.prepare_partner(partner_id, debtor, address, zip_code, city, country_id, email)
         if updated_doc:
             new_state = ("suspended" if reason["Rsn"] and reason["Rsn"] == "uncollectable|user" else "signed")
-            mandate_id = self.mandates.search([("reference", "=", mandate_number)])
+            mandate_id = self.find_mandates(mandate_number)
         else:
-            mandate_id = self.mandates.search([("reference", "=", doc.get("MndtId"))])
+            mandate_id = self.find_mandates(doc.get("MndtId"))
 
         mandate_vals = {
             "partner_id": partner_id.id if partner_id else False,
@@ -239,6 +414,9 @@ class OdooDocumentFeed(DocumentFeed):
             if updated_doc:
                 mandate_vals["reference"] = doc.get("MndtId")
             mandate_id.with_context(update_feed=True).write(mandate_vals)
+            if updated_doc and mandate_number != doc.get("MndtId"):
+                self.mandate_refs.pop(mandate_number, None)
+            self.remember_mandate(mandate_id)
             if reason:
                 update_reason = reason["Rsn"]
                 partner_id.message_post(body=f"Twikey mandate {mandate_number} was updated ({update_reason})")
@@ -250,12 +428,12 @@ class OdooDocumentFeed(DocumentFeed):
             mandate_vals["zip"] = zip_code
             mandate_vals["city"] = city
             mandate_vals["country_id"] = country_id.id if country_id else 0
-            mandate_id = self.mandates.create(mandate_vals)
+            mandate_id = self.remember_mandate(self.mandates.create(mandate_vals))
             partner_id.message_post(body=f"Twikey mandate {mandate_number} was activated")
 
         # Allow register payments
         if partner_id and mandate_id:
-            providers = self.paymentprovider.search([("code", "=", 'twikey')])
+            providers = self.providers
             if template_id:
                 _logger.debug("Finding linked providers for %s", template_id)
                 # find more specific
@@ -271,47 +449,74 @@ class OdooDocumentFeed(DocumentFeed):
 
         # Allow regular refunds
         if partner_id and iban:
-            customer_bank_id = self.env["res.partner.bank"].search([('acc_number', '=', iban)], limit=1)
+            account_key = sanitize_account_number(iban)
+            customer_bank_id = self._find(self.bank_accounts, self.partner_bank, "sanitized_acc_number", account_key)[:1]
             if not customer_bank_id:
-                bank = self.env["res.bank"].search([('bic', '=', bic)], limit=1)
-                if not bank:
-                    bank = self.env["res.bank"].create({"name":bic, "bic":bic})
                 _logger.info("Linked customer: " + str(partner_id.name) + " and iban: " + str(iban))
                 try:
-                    self.env["res.partner.bank"].create({
-                        "partner_id": partner_id.id,
-                        "bank_id": bank.id,
-                        "acc_number": iban
-                    })
+                    # a failure only costs the link to the account, not the mandate
+                    with self.env.cr.savepoint():
+                        bank = self._find(self.banks, self.bank, "bic", bic)[:1]
+                        if bic and not bank:
+                            bank = self.bank.create({"name":bic, "bic":bic})
+                        account = self.partner_bank.create({
+                            "partner_id": partner_id.id,
+                            "bank_id": bank.id,
+                            "acc_number": iban
+                        })
+                    if bank:
+                        self.banks[bic] = bank
+                    self.bank_accounts[account_key] = account
                     partner_id.message_post(body=f"Twikey account of {partner_id.name} was added")
                 except Exception as duplicate:
                     partner_id.message_post(body=f"Twikey account of {partner_id.name} was not added as probable duplicate")
 
     def start(self, position, number_of_updates):
-        _logger.info(f"Got new {number_of_updates} document update(s) from start={position}")
-        self.company.update({
-            "mandate_feed_pos": position
-        })
+        _logger.info(f"Got new {number_of_updates} document update(s) till position={position}")
+        self.page_size = number_of_updates
+
+    def done(self, position):
+        """ Page was fully applied, store its position and commit both together """
+        self.env["twikey.feed.checkpoint"].advance(self.company, "mandate", position, self.page_size)
+        commit(self.env)
+
+    def reset(self):
+        """ Records created by a failing item were rolled back, so forget everything looked up so far """
+        for cache in (self.countries, self.langs, self.templates, self.mandate_refs, self.partners,
+                      self.bank_accounts, self.banks):
+            cache.clear()
 
     def new_document(self, doc, evt_time):
         try:
-            self.new_update_document(doc, False, doc.get("MndtId"), False)
+            with self.env.cr.savepoint():
+                self.new_update_document(doc, False, doc.get("MndtId"), False)
         except Exception as e:
+            self.reset()
             _logger.exception("encountered an error in newDocument with mandate_number=%s:\n%s", doc.get("MndtId"), e)
+            return self.park(doc.get("MndtId"), e)
 
     def updated_document(self, original_doc_number, doc, reason, evt_time):
         try:
-            self.new_update_document(doc, True, original_doc_number, reason)
+            with self.env.cr.savepoint():
+                self.new_update_document(doc, True, original_doc_number, reason)
         except Exception as e:
+            self.reset()
             _logger.exception("encountered an error in updatedDocument with mandate_number=%s:\n%s", original_doc_number, e)
+            return self.park(original_doc_number, e)
 
     def cancelled_document(self, doc_number, reason, evt_time):
         try:
-            mandate_id = self.mandates.search([("reference", "=", doc_number)])
-            if mandate_id:
-                mandate_id.with_context(update_feed=True).write(
-                    {"state": "cancelled", "description": "Cancelled with reason : " + reason["Rsn"]}
-                )
-                mandate_id.partner_id.message_post(body=f"Twikey mandate {doc_number} was cancelled")
+            with self.env.cr.savepoint():
+                self.cancel_document(doc_number, reason)
         except Exception as e:
+            self.reset()
             _logger.exception("encountered an error in cancelDocument with mandate_number=%s:\n%s", doc_number, e)
+            return self.park(doc_number, e)
+
+    def cancel_document(self, doc_number, reason):
+        mandate_id = self.find_mandates(doc_number)
+        if mandate_id:
+            mandate_id.with_context(update_feed=True).write(
+                {"state": "cancelled", "description": "Cancelled with reason : " + reason["Rsn"]}
+            )
+            mandate_id.partner_id.message_post(body=f"Twikey mandate {doc_number} was cancelled")
@@ -0,0 +1,138 @@
+import json
+import logging
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+from ..utils import commit, run_concurrently, TimeBudget
+
+_logger = logging.getLogger(__name__)
+
+
+class TwikeyOutbox(models.Model):
+    """
+    Calls towards Twikey caused by changes in Odoo. Written in the transaction doing the change, so a rollback
+    drops the call too, and sent after the commit by the dispatcher instead of keeping the user waiting.
+    """
+    _name = "twikey.outbox"
+    _description = "Call waiting to be sent to Twikey"
+    _order = "id"
+
+    company_id = fields.Many2one("res.company", required=True, readonly=True, ondelete="cascade")
+    kind = fields.Selection(
+        [
+            ("invoice_update", "Invoice update"),
+            ("mandate_update", "Mandate update"),
+            ("mandate_cancel", "Mandate cancel"),
+        ],
+        required=True,
+        readonly=True,
+    )
+    reference = fields.Char(readonly=True, index=True, help="Twikey invoice id or mandate number")
+    payload = fields.Text(readonly=True)
+    attempts = fields.Integer(readonly=True)
+    next_attempt = fields.Datetime(readonly=True, index=True)
+    error = fields.Text(readonly=True)
+    state = fields.Selection(
+        [
+            ("pending", "Pending"),
+            ("done", "Done"),
+            ("failed", "Failed"),
+        ],
+        default="pending",
+        required=True,
+        readonly=True,
+        index=True,
+    )
+
+    @api.model
+    def enqueue(self, company, kind, reference, payload):
+        """ Queue a call to be sent once the current transaction is committed """
+        message = self.sudo().create({
+            "company_id": company.id,
+            "kind": kind,
+            "reference": reference,
+            "payload": json.dumps(payload),
+            "next_attempt": fields.Datetime.now(),
+        })
+        # only fires after the commit, nothing is sent when the transaction is rolled back
+        if not self.env.cr.precommit.data.get("twikey.outbox.triggered"):
+            self.env.cr.precommit.data["twikey.outbox.triggered"] = True
+            self.env.ref("payment_twikey.twikey_dispatch_outbox").sudo()._trigger()
+        return message
+
+    @staticmethod
+    def send(twikey_client, kind, reference, payload):
+        """ Do the actual call, runs in a worker thread so only plain data and the client """
+        if kind == "invoice_update":
+            return twikey_client.invoice.update(reference, payload)
+        if kind == "mandate_update":
+            return twikey_client.document.update(payload)
+        if kind == "mandate_cancel":
+            return twikey_client.document.cancel(reference, payload["rsn"])
+        raise ValueError(f"Unknown outbox kind {kind}")
+
+    def action_retry(self):
+        self.write({"state": "pending", "next_attempt": fields.Datetime.now()})
+        self.env.ref("payment_twikey.twikey_dispatch_outbox").sudo()._trigger()
+
+    @api.model
+    def _cron_dispatch(self):
+        params = self.env["ir.config_parameter"].sudo()
+        batch_size = int(params.get_param("twikey.outbox_batch_size", 100))
+        workers = int(params.get_param("twikey.outbox_workers", 8))
+        budget = TimeBudget.for_cron(self.env)
+        while not budget.expired():
+            # calls for the same invoice or mandate are sent one after the other, in order
+            self.env.cr.execute("""
+                SELECT id FROM twikey_outbox o
+                 WHERE state = 'pending' AND next_attempt <= (now() at time zone 'utc')
+                   AND NOT EXISTS (SELECT 1 FROM twikey_outbox p
+                                    WHERE p.state = 'pending' AND p.company_id = o.company_id
+                                      AND p.reference = o.reference AND p.id < o.id)
+                 ORDER BY id
+                 LIMIT %s
+            """, [batch_size])
+            batch = self.browse([row[0] for row in self.env.cr.fetchall()])
+            if not batch:
+                return
+            batch._dispatch(workers)
+            commit(self.env)
+        self.env.ref("payment_twikey.twikey_dispatch_outbox")._trigger()
+
+    def _dispatch(self, workers):
+        cancelled = False
+        for company in self.company_id:
+            messages = self.filtered(lambda message: message.company_id == company)
+            twikey_client = self.env["ir.config_parameter"].get_twikey_client(company=company)
+            if not twikey_client:
+                messages._failed("Twikey not configured", final=True)
+                continue
+            calls = [(message.id, message.kind, message.reference, json.loads(message.payload)) for message in messages]
+            results = run_concurrently(lambda call: self.send(twikey_client, *call[1:]), calls, max_workers=workers)
+            for (message_id, kind, reference, _payload), _result, error in results:
+                message = self.browse(message_id)
+                if error:
+                    _logger.error(f"Error while sending {kind} of {reference} to Twikey: {error}")
+                    message._failed(error)
+                else:
+                    message.write({"state": "done", "error": False})
+                    cancelled = cancelled or kind == "mandate_cancel"
+        if cancelled:
+            # pick up the cancelled mandates
+            self.env.ref("payment_twikey.twikey_update_feed")._trigger()
+
+    def _failed(self, error, final=False):
+        max_attempts = int(self.env["ir.config_parameter"].sudo().get_param("twikey.outbox_max_attempts", 5))
+        for message in self:
+            attempts = message.attempts + 1
+            message.write({
+                "attempts": attempts,
+                "error": str(error),
+                "next_attempt": fields.Datetime.now() + timedelta(minutes=2 ** attempts),
+                "state": "failed" if final or attempts >= max_attempts else "pending",
+            })
+            if message.state == "failed":
+                self.env['mail.channel'].search([('name', '=', 'twikey')]).message_post(
+                    subject="Twikey", body=f"Unable to send {message.kind} of {message.reference} to Twikey: {error}"
+                )
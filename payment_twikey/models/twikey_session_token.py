@@ -0,0 +1,75 @@
+import hashlib
+import logging
+
+from odoo import fields, models
+
+from ..twikey.client import TokenStore, TOKEN_REFRESH_MARGIN
+
+_logger = logging.getLogger(__name__)
+
+# first key of the advisory lock taken while logging in, second one is the company
+TOKEN_LOCK_NAMESPACE = 0x7717E1
+
+
+class TwikeySessionToken(models.Model):
+    _name = "twikey.session.token"
+    _description = "Twikey session token shared by all workers"
+
+    _sql_constraints = [("company_key_unique", "unique(company_id, key_hash)", "Only one token per company and key!")]
+
+    company_id = fields.Many2one("res.company", required=True, ondelete="cascade", index=True)
+    key_hash = fields.Char(required=True)
+    token = fields.Char()
+    merchant_id = fields.Char()
+    expires_at = fields.Datetime()
+
+
+class OdooTokenStore(TokenStore):
+    """
+    Session token store backed by the twikey_session_token table so all workers (and crons) of a database
+    reuse the same token. Uses its own cursor as the token needs to be visible to the other workers straight
+    away, regardless of what happens to the transaction of the caller.
+    """
+
+    def __init__(self, registry, company_id):
+        self.registry = registry
+        self.company_id = company_id
+
+    @staticmethod
+    def key_hash(client):
+        return hashlib.sha256(client.api_key.encode()).hexdigest()
+
+    def _fetch(self, cr, key_hash):
+        cr.execute("""SELECT token, merchant_id, expires_at FROM twikey_session_token
+                       WHERE company_id = %s AND key_hash = %s AND token IS NOT NULL
+                         AND expires_at > (now() at time zone 'utc') + %s""",
+                   [self.company_id, key_hash, TOKEN_REFRESH_MARGIN])
+        return cr.fetchone()
+
+    def get_token(self, client):
+        key_hash = self.key_hash(client)
+        with self.registry.cursor() as cr:
+            row = self._fetch(cr, key_hash)
+            if row:
+                return row
+            # Only one worker logs in, the others wait here and pick up its token
+            cr.execute("SELECT pg_advisory_xact_lock(%s, %s)", [TOKEN_LOCK_NAMESPACE, self.company_id])
+            row = self._fetch(cr, key_hash)
+            if row:
+                _logger.debug("Reusing token refreshed by another worker for company %s", self.company_id)
+                return row
+            token, merchant_id, expiry = client.login()
+            cr.execute("""INSERT INTO twikey_session_token (company_id, key_hash, token, merchant_id, expires_at,
+                                                             create_date, write_date)
+                          VALUES (%s, %s, %s, %s, %s, now() at time zone 'utc', now() at time zone 'utc')
+                          ON CONFLICT (company_id, key_hash) DO UPDATE
+                             SET token = EXCLUDED.token, merchant_id = EXCLUDED.merchant_id,
+                                 expires_at = EXCLUDED.expires_at, write_date = EXCLUDED.write_date""",
+                       [self.company_id, key_hash, token, merchant_id, expiry])
+            return token, merchant_id, expiry
+
+    def forget(self, client):
+        with self.registry.cursor() as cr:
+            # only drop the token the client was using, another worker might have refreshed it meanwhile
+            cr.execute("DELETE FROM twikey_session_token WHERE company_id = %s AND key_hash = %s AND token = %s",
+                       [self.company_id, self.key_hash(client), client.api_token])
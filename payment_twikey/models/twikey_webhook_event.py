@@ -0,0 +1,169 @@
+import json
+import logging
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+from ..utils import commit, FEED_BUSY, TimeBudget
+
+_logger = logging.getLogger(__name__)
+
+
+class TwikeyWebhookEvent(models.Model):
+    _name = "twikey.webhook.event"
+    _description = "Twikey webhook received but not yet handled"
+    _order = "id"
+
+    company_id = fields.Many2one("res.company", required=True, readonly=True, ondelete="cascade")
+    event_type = fields.Char(readonly=True, index=True)
+    payload = fields.Text(readonly=True, help="Parameters of the webhook as received from Twikey")
+    error = fields.Text(readonly=True)
+    processed_at = fields.Datetime(readonly=True)
+    feed = fields.Selection([("invoice", "Invoice"), ("mandate", "Mandate")], readonly=True,
+                            help="Feed to pull once the webhook itself was handled")
+    state = fields.Selection(
+        [
+            ("pending", "Pending"),
+            ("waiting", "Waiting for feed"),
+            ("done", "Done"),
+            ("failed", "Failed"),
+        ],
+        default="pending",
+        required=True,
+        readonly=True,
+        index=True,
+    )
+
+    @api.model
+    def receive(self, company, post):
+        """ Store a verified webhook and wake up the processor, the caller can answer Twikey straight away """
+        event = self.sudo().create({
+            "company_id": company.id,
+            "event_type": post.get("type"),
+            "payload": json.dumps(post),
+        })
+        # wait a bit so a burst of webhooks is handled by a single run
+        debounce = int(self.env["ir.config_parameter"].sudo().get_param("twikey.webhook_debounce", 5))
+        self.env.ref("payment_twikey.twikey_process_webhooks").sudo()._trigger(
+            at=fields.Datetime.now() + timedelta(seconds=debounce)
+        )
+        return event
+
+    @api.model
+    def _cron_process(self, limit=500):
+        """
+        Handle the pending webhooks, pulling every feed at most once per company for all webhooks asking for it.
+        Webhooks arriving during the run wait for the trailing run triggered by their arrival.
+        """
+        budget = TimeBudget.for_cron(self.env)
+        events = self.search([("state", "=", "pending")], limit=limit)
+        for event in events:
+            if budget.expired():
+                break
+            try:
+                feed = event.with_company(event.company_id)._handle()
+                if feed:
+                    # handled, only the pull is left, so the webhook isn't handled again when the pull is postponed
+                    event.write({"state": "waiting", "feed": feed})
+                else:
+                    event._done()
+            except Exception as e:
+                self.env.cr.rollback()
+                _logger.exception("Twikey: error while handling webhook %s", event.payload)
+                event._done(e)
+            commit(self.env)
+
+        pulls = {}
+        for event in self.search([("state", "=", "waiting")]):
+            # companies sharing a Twikey account share their feeds
+            key = (event.company_id._twikey_account_companies()[0], event.feed)
+            pulls[key] = pulls.get(key, self.browse()) | event
+
+        more = len(events) == limit
+        busy = False
+        for (company, feed), coalesced in pulls.items():
+            if budget.expired():
+                # left waiting, so pulled by the next run
+                more = True
+                break
+            _logger.info("Twikey: pulling %s feed of %s for %d webhooks", feed, company.name, len(coalesced))
+            try:
+                result = self.with_company(company)._pull(company, feed, budget)
+                if result == FEED_BUSY:
+                    # the running pull might be past the changes already, pull again once it is done
+                    busy = True
+                elif result:
+                    # stopped halfway, left waiting so the next run continues the feed
+                    more = True
+                else:
+                    coalesced._done()
+            except Exception as e:
+                self.env.cr.rollback()
+                _logger.exception("Twikey: error while pulling the %s feed of %s", feed, company.name)
+                coalesced._done(e)
+            commit(self.env)
+
+        if more or budget.expired():
+            self.env.ref("payment_twikey.twikey_process_webhooks")._trigger()
+        elif busy:
+            debounce = int(self.env["ir.config_parameter"].sudo().get_param("twikey.webhook_debounce", 5))
+            self.env.ref("payment_twikey.twikey_process_webhooks")._trigger(
+                at=fields.Datetime.now() + timedelta(seconds=debounce)
+            )
+
+    def _done(self, error=False):
+        self.write({
+            "state": "failed" if error else "done",
+            "error": str(error) if error else False,
+            "processed_at": fields.Datetime.now(),
+        })
+
+    @api.model
+    def _pull(self, company, feed, budget=None):
+        """ :return: True when the feed stopped before reaching its end, FEED_BUSY when it is running elsewhere """
+        if feed == "invoice":
+            return self.env["account.move"].sudo().update_invoice_feed(company, budget=budget)
+        return self.env["twikey.mandate.details"].sudo().update_feed(company, budget=budget)
+
+    def _handle(self):
+        """
+        Handle what can be handled for this webhook alone
+        :return: the feed (invoice or mandate) to pull for it, False if none
+        """
+        self.ensure_one()
+        post = json.loads(self.payload)
+        _logger.info("Twikey: handling webhook of type %s for %s", self.event_type, self.company_id.name)
+        webhooktype = post.get("type")
+        if webhooktype == "payment":
+            if post.get("id"):
+                self.env['payment.transaction'].sudo()._handle_notification_data('twikey', post)
+            else:
+                return "invoice"
+        elif webhooktype == "contract":
+            mandate_number = post.get("mandateNumber")
+            if mandate_number:
+                # Removal of a prepared mandate doesn't show up in the feed
+                mandate_id = self.env["twikey.mandate.details"].sudo().search([("reference", "=", mandate_number)])
+                if mandate_id:
+                    event = post.get("event")
+                    if event == "Invite":
+                        reason = post.get("reason")
+                        if reason == "removed":
+                            _logger.info(f"Removing twikey mandate {mandate_number}")
+                            mandate_id.with_context(update_feed=True).unlink()
+                        elif reason == "expired":
+                            if mandate_id.contract_temp_id.mandate_number_required:
+                                _logger.info(f"Not removing expired (mandate_number_required) {mandate_number}")
+                                mandate_id.message_post(body=f"Ignoring expiry for Twikey mandate {mandate_number}")
+                            else:
+                                _logger.info(f"Removing expired twikey mandate {mandate_number}")
+                                mandate_id.with_context(update_feed=True).unlink()
+                        else:
+                            _logger.warning("Unknown twikey mandate event of type "+event)
+                    else:
+                        if event not in ["Sign", "Update"]:
+                            _logger.info("Unknown twikey mandate event of type "+event)
+                        return "mandate"
+                else:
+                    return "mandate"
+        return False
@@ -7,3 +7,6 @@ from .paylink import PaylinkFeed
 from .invoice import InvoiceFeed
 from .refund import RefundFeed
 from .client import TwikeyError
+from .client import TokenStore
+from .aio import AsyncTwikeyClient
+from .client import FeedPage
@@ -0,0 +1,300 @@
+import asyncio
+import json
+import logging
+
+import requests
+
+try:
+    import aiohttp
+except ImportError:  # only required when using the AsyncTwikeyClient
+    aiohttp = None
+
+from .client import IDEMPOTENT_METHODS
+from .ratelimit import backoff_delay
+
+
+class AsyncResponse(object):
+    """Fully read response offering what the error handling of TwikeyClient expects of a requests.Response"""
+
+    def __init__(self, status_code, headers, text, url) -> None:
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+        self.url = url
+
+    def json(self):
+        try:
+            return json.loads(self.text)
+        except ValueError as e:
+            raise requests.exceptions.JSONDecodeError(str(e), self.text, 0)
+
+    def close(self):
+        pass
+
+    def __str__(self):
+        return "<AsyncResponse [%d]>" % self.status_code
+
+
+class AsyncTwikeyClient(object):
+    """
+    Asyncio flavour of a TwikeyClient with the same apis, but as coroutines and feeds as async iterators.
+    It wraps a regular TwikeyClient so the session token (and its store), the rate limiter and the error handling
+    are shared with blocking callers.
+
+    Sample usage
+
+    async with AsyncTwikeyClient(twikey_client, concurrency=20) as client:
+        results = await asyncio.gather(*[client.invoice.create(data) for data in invoices], return_exceptions=True)
+        async for invoice in client.invoice.feed(position, "meta"):
+            ...
+    """
+
+    def __init__(self, client, concurrency=10) -> None:
+        if aiohttp is None:
+            raise ImportError("The AsyncTwikeyClient requires aiohttp to be installed")
+        self.client = client
+        self.concurrency = concurrency
+        self.semaphore = None
+        self.session = None
+        self.document = AsyncDocument(self)
+        self.transaction = AsyncTransaction(self)
+        self.paylink = AsyncPaylink(self)
+        self.invoice = AsyncInvoice(self)
+        self.refund = AsyncRefund(self)
+        self.logger = logging.getLogger(__name__)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def open(self):
+        # Created here as both need a running event loop
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+        )
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    def instance_url(self, url=""):
+        return self.client.instance_url(url)
+
+    def headers(self, content_type="application/x-www-form-urlencoded"):
+        return self.client.headers(content_type)
+
+    async def refresh_token_if_required(self):
+        if not self.client.token_valid():
+            # login (and the token store) are blocking, keep them out of the event loop
+            await asyncio.get_running_loop().run_in_executor(None, self.client.refreshTokenIfRequired)
+
+    async def request(self, context, method, url, timeout=15, **kwargs):
+        """
+        Perform a call with at most `concurrency` calls in flight, retrying like TwikeyClient.request
+        :return: AsyncResponse when successful
+        :raise TwikeyError when the call failed
+        """
+        if self.session is None:
+            await self.open()
+        method = method.upper()
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        attempt = 0
+        async with self.semaphore:
+            while True:
+                await asyncio.sleep(self.client.rate_limiter.reserve())
+                try:
+                    async with self.session.request(method, url, timeout=client_timeout, **kwargs) as resp:
+                        response = AsyncResponse(resp.status, resp.headers, await resp.text(), str(resp.url))
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if method not in IDEMPOTENT_METHODS or attempt >= self.client.max_retries:
+                        raise self.client.raise_error_from_request(context, e)
+                    delay = backoff_delay(attempt)
+                else:
+                    delay = self.client.retry_delay(method, response, attempt)
+                    if delay is None:
+                        if "ApiErrorCode" in response.headers:
+                            raise self.client.raise_error(context, response)
+                        return response
+                attempt += 1
+                self.client.rate_limiter.pause(delay)
+
+    async def templates(self):
+        await self.refresh_token_if_required()
+        response = await self.request("Template", "GET", self.instance_url("/template"), headers=self.headers())
+        return response.json()
+
+    async def feed(self, context, url, key, start_position=False):
+        """Iterate over all items (under key) of the feed at url, page by page"""
+        await self.refresh_token_if_required()
+        headers = self.headers()
+        if start_position:
+            headers["X-RESUME-AFTER"] = str(start_position)
+        while True:
+            response = await self.request(context, "GET", url, headers=headers)
+            if response.status_code >= 400:
+                raise self.client.raise_error(context, response)
+            items = response.json()[key]
+            if len(items) == 0:
+                break
+            self.logger.debug("Feed handling : %d items till %s" % (len(items), response.headers.get("X-LAST")))
+            for item in items:
+                yield item
+            # long feeds might outlive the token
+            await self.refresh_token_if_required()
+            headers = self.headers()
+
+
+class AsyncDocument(object):
+    def __init__(self, client) -> None:
+        super().__init__()
+        self.client = client
+
+    async def create(self, data):
+        await self.client.refresh_token_if_required()
+        response = await self.client.request("Invite", "POST", self.client.instance_url("/invite"),
+                                             data=data or {}, headers=self.client.headers())
+        return response.json()
+
+    async def sign(self, data):
+        await self.client.refresh_token_if_required()
+        response = await self.client.request("Sign", "POST", self.client.instance_url("/sign"),
+                                             data=data or {}, headers=self.client.headers())
+        return response.json()
+
+    async def update(self, data):
+        await self.client.refresh_token_if_required()
+        await self.client.request("Update", "POST", self.client.instance_url("/mandate/update"),
+                                  data=data or {}, headers=self.client.headers())
+
+    async def cancel(self, mandate_number, reason):
+        await self.client.refresh_token_if_required()
+        await self.client.request("Cancel", "DELETE", self.client.instance_url("/mandate"),
+                                  params={"mndtId": mandate_number, "rsn": reason}, headers=self.client.headers())
+
+    async def update_customer(self, customer_id, data):
+        await self.client.refresh_token_if_required()
+        await self.client.request("Update customer", "PATCH", self.client.instance_url("/customer/" + str(customer_id)),
+                                  params=data, headers=self.client.headers())
+
+    def feed(self, start_position=False):
+        """Async iterator over the raw mandate feed messages"""
+        url = self.client.instance_url("/mandate?include=id&include=mandate&include=person")
+        return self.client.feed("Mandate feed", url, "Messages", start_position)
+
+
+class AsyncInvoice(object):
+    def __init__(self, client) -> None:
+        super().__init__()
+        self.client = client
+
+    async def create(self, data, origin=False, purpose=False, manual=False):
+        await self.client.refresh_token_if_required()
+        headers = self.client.headers("application/json")
+        if origin:
+            headers["X-PARTNER"] = origin
+        if purpose:
+            headers["X-Purpose"] = purpose
+        if manual:
+            headers["X-MANUAL"] = "true"
+        response = await self.client.request("Create invoice", "POST", self.client.instance_url("/invoice"),
+                                             json=data or {}, headers=headers)
+        return response.json()
+
+    async def update(self, invoice_id, data):
+        await self.client.refresh_token_if_required()
+        response = await self.client.request("Update invoice", "PUT", self.client.instance_url("/invoice/" + invoice_id),
+                                             json=data or {}, headers=self.client.headers("application/json"))
+        return response.json()
+
+    def feed(self, start_position=False, *includes):
+        """Async iterator over the invoices of the feed"""
+        _includes = ""
+        for include in includes:
+            _includes += "&include=" + include
+        url = self.client.instance_url("/invoice?include=customer" + _includes)
+        return self.client.feed("Invoice feed", url, "Invoices", start_position)
+
+    def geturl(self, invoice_id):
+        return self.client.client.invoice.geturl(invoice_id)
+
+
+class AsyncTransaction(object):
+    def __init__(self, client) -> None:
+        super().__init__()
+        self.client = client
+
+    async def create(self, data):
+        await self.client.refresh_token_if_required()
+        response = await self.client.request("Create transaction", "POST", self.client.instance_url("/transaction"),
+                                             data=data or {}, headers=self.client.headers())
+        return response.json()["Entries"][0]
+
+    def feed(self):
+        """Async iterator over the transaction feed"""
+        return self.client.feed("Feed transaction", self.client.instance_url("/transaction"), "Entries")
+
+    async def batch_send(self, ct, colltndt=False):
+        data = {"ct": ct}
+        if colltndt:
+            data["colltndt"] = colltndt
+        await self.client.refresh_token_if_required()
+        response = await self.client.request("Send batch", "POST", self.client.instance_url("/collect"),
+                                             data=data, headers=self.client.headers(), timeout=60)
+        return response.json()
+
+    async def batch_import(self, pain008_xml):
+        await self.client.refresh_token_if_required()
+        response = await self.client.request("Import batch", "POST", self.client.instance_url("/collect/import"),
+                                             data=pain008_xml, headers=self.client.headers(), timeout=60)
+        return response.json()
+
+    async def reporting_import(self, reporting_content):
+        await self.client.refresh_token_if_required()
+        await self.client.request("Import reporting", "POST", self.client.instance_url("/reporting"),
+                                  data=reporting_content, headers=self.client.headers(), timeout=60)
+
+
+class AsyncRefund(object):
+    def __init__(self, client) -> None:
+        super().__init__()
+        self.client = client
+
+    async def create_beneficiary_account(self, data):
+        await self.client.refresh_token_if_required()
+        response = await self.client.request("Create beneficiary", "POST",
+                                             self.client.instance_url("/transfers/beneficiaries"),
+                                             data=data or {}, headers=self.client.headers())
+        return response.json()
+
+    async def create(self, customerNumber, transactionDetails):
+        data = dict(transactionDetails) or {}
+        data["customerNumber"] = customerNumber
+        await self.client.refresh_token_if_required()
+        response = await self.client.request("Create refund", "POST", self.client.instance_url("/transfer"),
+                                             data=data, headers=self.client.headers())
+        return response.json()["Entries"][0]
+
+    def feed(self):
+        """Async iterator over the refund feed"""
+        return self.client.feed("Feed refunds", self.client.instance_url("/transfer"), "Entries")
+
+
+class AsyncPaylink(object):
+    def __init__(self, client) -> None:
+        super().__init__()
+        self.client = client
+
+    async def create(self, data):
+        await self.client.refresh_token_if_required()
+        response = await self.client.request("Create paylink", "POST", self.client.instance_url("/payment/link"),
+                                             data=data or {}, headers=self.client.headers())
+        return response.json()
+
+    def feed(self):
+        """Async iterator over the paylink feed"""
+        return self.client.feed("Feed paylink", self.client.instance_url("/payment/link/feed"), "Links")
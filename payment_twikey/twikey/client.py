@@ -1,14 +1,32 @@
 import datetime
 import json
+from collections import namedtuple
 import logging
+import random
+import threading
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from .document import Document
 from .invoice import Invoice
 from .paylink import Paylink
 from .transaction import Transaction
 from .refund import Refund
+from .ratelimit import RateLimiter, backoff_delay
+from . import decode, pipeline
+
+# A non empty page of a feed, position (X-LAST) allows resuming after this page
+FeedPage = namedtuple("FeedPage", ["position", "items"])
+
+TOKEN_VALIDITY = datetime.timedelta(hours=24)
+# Methods that can safely be repeated after a server error or a dropped connection
+IDEMPOTENT_METHODS = ("GET", "PUT", "DELETE", "HEAD", "OPTIONS")
+# Never wait longer than this on a single Retry-After, rather fail and let the next run pick it up
+MAX_RETRY_AFTER = 120
+
+# Refresh somewhat before the real expiry so a token never expires halfway a batch of calls
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=30)
 
 
 class TwikeyClient(object):
@@ -19,6 +37,9 @@ class TwikeyClient(object):
     private_key = None
     vendorPrefix = b"own"
     api_base = "https://api.twikey.com"
+    session = None
+    token_expiry = None  # utc, once authenticated
+    token_store = None
 
     document = None
     transaction = None
@@ -32,12 +53,21 @@ class TwikeyClient(object):
         base_url="https://api.twikey.com",
         user_agent="twikey-python/v0.1.0",
         private_key=None,
+        pool_size=10,
+        token_store=None,
+        rate_limit=None,
+        max_retries=3,
     ) -> None:
         self.user_agent = user_agent
         self.api_key = api_key
         self.private_key = private_key
         self.api_base = base_url
         self.merchant_id = 0
+        self.session = self.new_session(pool_size)
+        self.token_store = token_store
+        self.token_lock = threading.Lock()
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.max_retries = max_retries
         self.document = Document(self)
         self.transaction = Transaction(self)
         self.paylink = Paylink(self)
@@ -48,6 +78,80 @@ class TwikeyClient(object):
     def instance_url(self, url=""):
         return "{}{}".format(self.api_base, url)
 
+    @staticmethod
+    def new_session(pool_size=10):
+        """
+        Build the http session shared by all apis of this client. Connections are kept alive and pooled
+        so consecutive calls (eg. sending invoices or fetching feed pages) reuse the same tls connection.
+        Every client has its own session, so different api keys (companies) never share connections.
+        @:param pool_size maximum number of connections kept open towards Twikey
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({"Connection": "keep-alive"})
+        return session
+
+    def request(self, method, url, **kwargs):
+        """
+        Perform a call towards Twikey honouring the client side rate limit. Throttled calls (429 or a
+        X-Rate-Limit-Retry-After-Seconds header) are retried after the requested delay, server errors and
+        connection problems with a jittered exponential backoff. Non-idempotent calls are only retried on
+        answers that guarantee nothing was processed (429/503).
+        @:param method http method
+        @:param url full url
+        @:return the (last) response
+        """
+        method = method.upper()
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            if attempt and hasattr(kwargs.get("data"), "seek"):
+                # streamed body, send it again from the start
+                kwargs["data"].seek(0)
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if method not in IDEMPOTENT_METHODS or attempt >= self.max_retries:
+                    raise
+                delay = backoff_delay(attempt)
+                self.logger.info("Retrying %s %s in %.1fs after %s" % (method, url, delay, e.__class__.__name__))
+            else:
+                delay = self.retry_delay(method, response, attempt)
+                if delay is None:
+                    return response
+                self.logger.info("Retrying %s %s in %.1fs after status %d" % (method, url, delay, response.status_code))
+                response.close()
+            attempt += 1
+            # everyone sharing this client backs off, not only this call
+            self.rate_limiter.pause(delay)
+
+    def retry_delay(self, method, response, attempt):
+        """
+        :return: seconds to wait before retrying the call or None when the response should be returned as is
+        """
+        if attempt >= self.max_retries:
+            return None
+        if response.status_code in (429, 503):
+            # nothing was processed, so even non-idempotent calls can be repeated, after the delay asked (if any)
+            retry_after = response.headers.get("X-Rate-Limit-Retry-After-Seconds") or response.headers.get("Retry-After")
+            try:
+                seconds = float(retry_after)
+            except (TypeError, ValueError):
+                return backoff_delay(attempt)
+            if seconds > MAX_RETRY_AFTER:
+                return None
+            return seconds + random.uniform(0, 1)
+        if response.status_code in (500, 502, 504) and method in IDEMPOTENT_METHODS:
+            return backoff_delay(attempt)
+        return None
+
+    def close(self):
+        """Release the pooled connections of this client"""
+        if self.session:
+            self.session.close()
+
     @staticmethod
     def get_totp(vendor_prefix, secret):
         """
@@ -77,41 +181,73 @@ class TwikeyClient(object):
         if not self.api_key:
             raise TwikeyError(ctx="Config", error_code="Api-Key", error="No key defined - %s" % self.api_base)
 
-        now = datetime.datetime.now()
-        if self.lastLogin is None or (now - self.lastLogin).seconds > 23 * 3600:
-            payload = {"apiToken": self.api_key}
-            if self.private_key:
-                payload["otp"] = self.get_totp(self.vendorPrefix, self.private_key)
+        if self.token_valid():
+            self.logger.debug("Reusing token {} valid till {}".format(self.api_token, self.token_expiry))
+            return
 
-            self.logger.debug("Authenticating with {} using {}...".format(self.api_base, self.api_key[0:10]))
-            response = requests.post(
-                self.instance_url(),
-                data=payload,
-                headers={"User-Agent": self.user_agent},
-                timeout=15,
-            )
-
-            if "ApiErrorCode" in response.headers:
-                error_json = response.json()
-                self.logger.error(error_json)
-                error_code = response.headers["ApiErrorCode"]
-                error_json_message = "Error authenticating : %s" % error_json["message"]
-                raise TwikeyError(ctx="Config", error_code=error_code, error=error_json_message)
-
-            if "X-Rate-Limit-Retry-After-Seconds" in response.headers:
-                retry_after_seconds = response.headers["X-Rate-Limit-Retry-After-Seconds"]
-                error_message = "Too many login's, please try again after %s sec." % retry_after_seconds
-                raise TwikeyError(ctx="Config", error_code="Rate limit", error=error_message)
-
-            if "Authorization" in response.headers:
-                self.api_token = response.headers["Authorization"]
-                self.merchant_id = response.headers["X-MERCHANT-ID"]
-                self.lastLogin = datetime.datetime.now()
+        # Single flight, other threads wait for the login in progress and reuse its token
+        with self.token_lock:
+            if self.token_valid():
+                self.logger.debug("Reusing token refreshed by another thread")
+            elif self.token_store:
+                # Let the store decide whether someone else already logged in with this key
+                self.api_token, self.merchant_id, self.token_expiry = self.token_store.get_token(self)
             else:
-                error_message = "Invalid response : %s" % str(response)
-                raise TwikeyError(ctx="Config", error_code="Authentication", error=error_message)
+                self.login()
+
+    def invalidate_token(self):
+        """Token was refused by Twikey (eg. expired or logged out elsewhere), make sure the next call logs in"""
+        with self.token_lock:
+            if self.token_store and self.api_token:
+                self.token_store.forget(self)
+            self.api_token = None
+            self.token_expiry = None
+
+    def token_valid(self):
+        return self.api_token is not None and self.token_expiry is not None \
+            and datetime.datetime.utcnow() < self.token_expiry - TOKEN_REFRESH_MARGIN
+
+    def login(self):
+        """
+        Authenticate towards Twikey, use refreshTokenIfRequired unless you really need a new token
+        :return: tuple of (api_token, merchant_id, token_expiry)
+        """
+        payload = {"apiToken": self.api_key}
+        if self.private_key:
+            payload["otp"] = self.get_totp(self.vendorPrefix, self.private_key)
+
+        self.logger.debug("Authenticating with {} using {}...".format(self.api_base, self.api_key[0:10]))
+        # validity starts when Twikey issues the token, so take the time before the call
+        requested_at = datetime.datetime.utcnow()
+        response = self.request(
+            "POST",
+            self.instance_url(),
+            data=payload,
+            headers={"User-Agent": self.user_agent},
+            timeout=15,
+        )
+
+        if "ApiErrorCode" in response.headers:
+            error_json = response.json()
+            self.logger.error(error_json)
+            error_code = response.headers["ApiErrorCode"]
+            error_json_message = "Error authenticating : %s" % error_json["message"]
+            raise TwikeyError(ctx="Config", error_code=error_code, error=error_json_message)
+
+        if "X-Rate-Limit-Retry-After-Seconds" in response.headers:
+            retry_after_seconds = response.headers["X-Rate-Limit-Retry-After-Seconds"]
+            error_message = "Too many login's, please try again after %s sec." % retry_after_seconds
+            raise TwikeyError(ctx="Config", error_code="Rate limit", error=error_message)
+
+        if "Authorization" in response.headers:
+            self.api_token = response.headers["Authorization"]
+            self.merchant_id = response.headers["X-MERCHANT-ID"]
+            self.lastLogin = datetime.datetime.now()
+            self.token_expiry = requested_at + TOKEN_VALIDITY
         else:
-            self.logger.debug("Reusing token {} valid till {}".format(self.api_token, self.lastLogin))
+            error_message = "Invalid response : %s" % str(response)
+            raise TwikeyError(ctx="Config", error_code="Authentication", error=error_message)
+        return self.api_token, self.merchant_id, self.token_expiry
 
     def headers(self, content_type="application/x-www-form-urlencoded"):
         return {
@@ -123,7 +259,7 @@ class TwikeyClient(object):
 
     def templates(self):
         try:
-            response = requests.get(self.instance_url("/template"),headers=self.headers(),timeout=15,)
+            response = self.request("GET", self.instance_url("/template"),headers=self.headers(),timeout=15,)
             if "ApiErrorCode" in response.headers:
                 raise self.raise_error("Feed", response)
             if response.status_code == 200:
@@ -133,8 +269,76 @@ class TwikeyClient(object):
         except requests.exceptions.RequestException as e:
             raise self.raise_error_from_request("Template error", e)
 
+    def feed_pages(self, context, url, key, start_position=False, prefetch=0, stream=False):
+        """
+        Lazily iterate over the pages of a feed
+        @:param context used in errors
+        @:param url url of the feed
+        @:param key name of the list holding the items in the response (eg. Invoices)
+        @:param start_position position to resume after (if any)
+        @:param prefetch number of pages to fetch in the background while the current page is handled
+        @:param stream decode the items while the page is received instead of reading the full body first
+                       (requires ijson)
+        @:return generator of FeedPage
+        """
+        self.refreshTokenIfRequired()
+        return pipeline.prefetch(self._feed_pages(context, url, key, start_position, stream), prefetch)
+
+    def feed_items(self, context, url, key, start_position=False, prefetch=0, stream=False):
+        """
+        Lazily iterate over all items of a feed, see feed_pages. When streaming without prefetch every item is
+        handed out as soon as it is parsed, without waiting for the rest of its page.
+        """
+        if stream and not prefetch:
+            self.refreshTokenIfRequired()
+            yield from self._feed_stream(context, url, key, start_position)
+            return
+        for page in self.feed_pages(context, url, key, start_position, prefetch, stream):
+            yield from page.items
+
+    def _feed_responses(self, context, url, start_position=False, stream=False):
+        """Responses of the consecutive pages of a feed, the caller stops asking once a page is empty"""
+        headers = self.headers()
+        if start_position:
+            headers["X-RESUME-AFTER"] = str(start_position)
+        while True:
+            response = self.request("GET", url=url, headers=headers, timeout=15, stream=stream)
+            if "ApiErrorCode" in response.headers or response.status_code >= 400:
+                raise self.raise_error(context, response)
+            yield response
+            # long feeds might outlive the token
+            self.refreshTokenIfRequired()
+            headers = self.headers()
+
+    def _feed_pages(self, context, url, key, start_position=False, stream=False):
+        try:
+            for response in self._feed_responses(context, url, start_position, stream):
+                if stream:
+                    items = list(decode.iter_items(response, key))
+                else:
+                    items = decode.loads(response.content)[key]
+                if len(items) == 0:
+                    return
+                yield FeedPage(response.headers.get("X-LAST"), items)
+        except requests.exceptions.RequestException as e:
+            raise self.raise_error_from_request(context, e)
+
+    def _feed_stream(self, context, url, key, start_position=False):
+        try:
+            for response in self._feed_responses(context, url, start_position, stream=True):
+                empty = True
+                for item in decode.iter_items(response, key):
+                    empty = False
+                    yield item
+                if empty:
+                    return
+        except requests.exceptions.RequestException as e:
+            raise self.raise_error_from_request(context, e)
+
     def raise_error(self, context, response):
         self.logger.error("Error in '%s' response %s " % (context, response.text))
+        if response.status_code == 401:
+            self.invalidate_token()
         try:
             error_json = response.json()
             extra = error_json["extra"] if "extra" in error_json else False
@@ -148,7 +352,8 @@ class TwikeyClient(object):
 
     def logout(self):
         self.logger.info("Logging out of Twikey")
-        response = requests.get(
+        response = self.request(
+            "GET",
             self.instance_url(),
             headers={"User-Agent": self.user_agent},
             timeout=15,
@@ -158,8 +363,32 @@ class TwikeyClient(object):
             if "err" in response_text["code"]:
                 raise TwikeyError(ctx="Logout",error_code="Logout", error=response_text["message"])
 
+        if self.token_store:
+            self.token_store.forget(self)
         self.api_token = None
         self.lastLogin = None
+        self.token_expiry = None
+
+
+class TokenStore(object):
+    """
+    Allows clients in different processes using the same api key to share a single session token.
+    The default implementation doesn't share anything and just logs in.
+    """
+
+    def get_token(self, client):
+        """
+        Return a valid token for the key of the client, logging in (via client.login) only when
+        no other client did so already.
+        :return: tuple of (api_token, merchant_id, token_expiry)
+        """
+        return client.login()
+
+    def forget(self, client):
+        """
+        Drop the shared token of the client eg. after logging out
+        """
+        pass
 
 
 class TwikeyError(Exception):
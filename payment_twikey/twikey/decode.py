@@ -0,0 +1,46 @@
+import json
+
+import requests
+from urllib3.exceptions import HTTPError
+
+try:
+    import orjson
+except ImportError:  # optional, only makes decoding full pages faster
+    orjson = None
+
+try:
+    import ijson
+except ImportError:  # optional, only required to decode feed pages while they are being received
+    ijson = None
+
+
+def loads(content):
+    """
+    Decode a json document, with orjson when installed
+    :param content: bytes or str
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def iter_items(response, key):
+    """
+    Yield the items of the list `key` of a json response one by one while they are being parsed, so neither the
+    body nor the complete list is held in memory. Falls back to decoding the body at once when ijson is missing.
+    :param response: requests response obtained with stream=True, its body not yet read
+    :param key: name of the list holding the items (eg. Invoices)
+    """
+    if ijson is None:
+        yield from loads(response.content)[key]
+        return
+    # undo gzip/deflate as the body is read from the socket
+    response.raw.decode_content = True
+    try:
+        # ijson picks its fastest (C) backend available, floats as these are what json would give
+        yield from ijson.items(response.raw, key + ".item", use_float=True)
+    except HTTPError as e:
+        # as requests would have raised it when reading the body at once
+        raise requests.exceptions.ConnectionError(e, response=response)
+    finally:
+        response.close()
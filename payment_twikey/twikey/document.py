@@ -14,7 +14,7 @@ class Document(object):
         data = data or {}
         try:
             self.client.refreshTokenIfRequired()
-            response = requests.post(url=url, data=data, headers=self.client.headers(), timeout=15)
+            response = self.client.request("POST", url=url, data=data, headers=self.client.headers(), timeout=15)
             if "ApiErrorCode" in response.headers:
                 raise self.client.raise_error("Invite", response)
             json_response = response.json()
@@ -28,7 +28,7 @@ class Document(object):
         data = data or {}
         try:
             self.client.refreshTokenIfRequired()
-            response = requests.post(url=url, data=data, headers=self.client.headers(), timeout=15)
+            response = self.client.request("POST", url=url, data=data, headers=self.client.headers(), timeout=15)
             if "ApiErrorCode" in response.headers:
                 raise self.client.raise_error("Sign", response)
             json_response = response.json()
@@ -42,7 +42,7 @@ class Document(object):
         data = data or {}
         try:
             self.client.refreshTokenIfRequired()
-            response = requests.post(url=url, data=data, headers=self.client.headers(), timeout=15)
+            response = self.client.request("POST", url=url, data=data, headers=self.client.headers(), timeout=15)
             self.logger.debug("Updated mandate : {} response={}".format(data, response))
             if "ApiErrorCode" in response.headers:
                 raise self.client.raise_error("Update", response)
@@ -53,70 +53,77 @@ class Document(object):
         url = self.client.instance_url("/mandate?mndtId=" + mandate_number + "&rsn=" + reason)
         try:
             self.client.refreshTokenIfRequired()
-            response = requests.delete(url=url, headers=self.client.headers(), timeout=15)
+            response = self.client.request("DELETE", url=url, headers=self.client.headers(), timeout=15)
             self.logger.debug("Cancel mandate : %s status=%d" % (mandate_number, response.status_code))
             if "ApiErrorCode" in response.headers:
                 raise self.client.raise_error("Cancel", response)
         except requests.exceptions.RequestException as e:
             raise self.client.raise_error_from_request("Cancel", e)
 
-    def feed(self, document_feed, start_position=False):
-        url = self.client.instance_url("/mandate?include=id&include=mandate&include=person")
-        try:
-            self.client.refreshTokenIfRequired()
-            initheaders = self.client.headers()
-            if start_position:
-                initheaders["X-RESUME-AFTER"] = str(start_position)
-            response = requests.get(
-                url=url,
-                headers=initheaders,
-                timeout=15,
-            )
-            if "ApiErrorCode" in response.headers:
-                raise self.client.raise_error("Feed", response)
-            feed_response = response.json()
-            while len(feed_response["Messages"]) > 0:
-                self.logger.debug("Feed handling : %d from %s till %s" % (
-                    len(feed_response["Messages"]), start_position, response.headers["X-LAST"]))
-                document_feed.start(response.headers["X-LAST"], len(feed_response["Messages"]))
-                error = False
-                for msg in feed_response["Messages"]:
-                    if "AmdmntRsn" in msg:
-                        mndt_id_ = msg["OrgnlMndtId"]
-                        self.logger.debug("Feed update : %s" % mndt_id_)
-                        mndt_ = msg["Mndt"]
-                        rsn_ = msg["AmdmntRsn"]
-                        at_ = msg["EvtTime"]
-                        error = document_feed.updated_document(mndt_id_, mndt_, rsn_, at_)
-                    elif "CxlRsn" in msg:
-                        mndt_ = msg["OrgnlMndtId"]
-                        rsn_ = msg["CxlRsn"]
-                        at_ = msg["EvtTime"]
-                        self.logger.debug("Feed cancel : %s" % mndt_)
-                        error = document_feed.cancelled_document(mndt_, rsn_, at_)
-                    else:
-                        mndt_ = msg["Mndt"]
-                        at_ = msg["EvtTime"]
-                        self.logger.debug("Feed create : %s" % mndt_)
-                        error = document_feed.new_document(mndt_, at_)
-                    if error:
-                        break
+    def feed(self, document_feed, start_position=False, prefetch=0, stream=False):
+        """
+        Handle all updates of the mandate feed
+        :param document_feed: DocumentFeed handling the updates
+        :param start_position: position to resume after (if any)
+        :param prefetch: number of pages to fetch in the background while the current page is handled
+        :param stream: decode the pages while they are received, see TwikeyClient.feed_pages
+        """
+        for page in self.pages(start_position, prefetch=prefetch, stream=stream):
+            self.logger.debug("Feed handling : %d from %s till %s" % (len(page.items), start_position, page.position))
+            document_feed.start(page.position, len(page.items))
+            error = False
+            for msg in page.items:
+                error = self.dispatch(document_feed, msg)
                 if error:
-                    self.logger.debug("Error while handing invoice, stopping")
                     break
-                response = requests.get(url=url, headers=self.client.headers(), timeout=15, )
-                if "ApiErrorCode" in response.headers:
-                    raise self.client.raise_error("Feed", response)
-                feed_response = response.json()
-            self.logger.debug("Done handing mandate feed")
-        except requests.exceptions.RequestException as e:
-            raise self.client.raise_error_from_request("Mandate feed", e)
+            if error:
+                self.logger.debug("Error while handing invoice, stopping")
+                break
+        self.logger.debug("Done handing mandate feed")
+
+    def dispatch(self, document_feed, msg):
+        """
+        Hand a single message of the feed to the matching method of the document_feed
+        :return: error of the document_feed or False to continue
+        """
+        if "AmdmntRsn" in msg:
+            mndt_id_ = msg["OrgnlMndtId"]
+            self.logger.debug("Feed update : %s" % mndt_id_)
+            mndt_ = msg["Mndt"]
+            rsn_ = msg["AmdmntRsn"]
+            at_ = msg["EvtTime"]
+            return document_feed.updated_document(mndt_id_, mndt_, rsn_, at_)
+        elif "CxlRsn" in msg:
+            mndt_ = msg["OrgnlMndtId"]
+            rsn_ = msg["CxlRsn"]
+            at_ = msg["EvtTime"]
+            self.logger.debug("Feed cancel : %s" % mndt_)
+            return document_feed.cancelled_document(mndt_, rsn_, at_)
+        else:
+            mndt_ = msg["Mndt"]
+            at_ = msg["EvtTime"]
+            self.logger.debug("Feed create : %s" % mndt_)
+            return document_feed.new_document(mndt_, at_)
+
+    def pages(self, start_position=False, prefetch=0, stream=False):
+        """
+        Lazily iterate over the mandate feed page by page, see dispatch for handling the raw messages
+        :return: generator of FeedPage(position, messages)
+        """
+        return self.client.feed_pages("Mandate feed", self._feed_url(), "Messages", start_position, prefetch, stream)
+
+    def items(self, start_position=False, prefetch=0, stream=False):
+        """Lazily iterate over all messages of the feed"""
+        return self.client.feed_items("Mandate feed", self._feed_url(), "Messages", start_position, prefetch, stream)
+
+    def _feed_url(self):
+        return self.client.instance_url("/mandate?include=id&include=mandate&include=person")
 
     def update_customer(self, customer_id, data):
         url = self.client.instance_url("/customer/" + str(customer_id))
         try:
             self.client.refreshTokenIfRequired()
-            response = requests.patch(url=url, params=data, headers=self.client.headers(), timeout=15)
+            response = self.client.request("PATCH", url=url, params=data, headers=self.client.headers(), timeout=15)
             if "ApiErrorCode" in response.headers:
                 raise self.client.raise_error("Cancel", response)
         except requests.exceptions.RequestException as e:
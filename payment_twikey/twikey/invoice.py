@@ -2,6 +2,8 @@ import logging
 
 import requests
 
+from .payload import JsonFileBody
+
 
 class Invoice(object):
     def __init__(self, client) -> None:
@@ -9,7 +11,11 @@ class Invoice(object):
         self.client = client
         self.logger = logging.getLogger(__name__)
 
-    def create(self, data, origin=False, purpose=False, manual=False):
+    def create(self, data, origin=False, purpose=False, manual=False, pdf=None):
+        """
+        :param pdf: bytes or binary file object of the pdf, streamed as base64 into the request instead of
+                    having to be added to data (and so held in memory) as a base64 string
+        """
         url = self.client.instance_url("/invoice")
         data = data or {}
         try:
@@ -21,11 +27,16 @@ class Invoice(object):
                 headers["X-Purpose"] = purpose
             if manual:
                 headers["X-MANUAL"] = "true"
-            response = requests.post(
+            if pdf is not None:
+                body = {"data": JsonFileBody(data, "pdf", pdf)}
+            else:
+                body = {"json": data}
+            response = self.client.request(
+                "POST",
                 url=url,
-                json=data,
                 headers=headers,
                 timeout=15,
+                **body
             )
             json_response = response.json()
             if "ApiErrorCode" in response.headers:
@@ -41,7 +52,7 @@ class Invoice(object):
         try:
             self.client.refreshTokenIfRequired()
             headers = self.client.headers("application/json")
-            response = requests.put(url=url, json=data, headers=headers, timeout=15)
+            response = self.client.request("PUT", url=url, json=data, headers=headers, timeout=15)
             json_response = response.json()
             if "ApiErrorCode" in response.headers:
                 raise self.client.raise_error("Update invoice", response)
@@ -51,47 +62,48 @@ class Invoice(object):
             raise self.client.raise_error_from_request("Update invoice", e)
 
     #include=meta&include=lastpayment
-    def feed(self, invoice_feed, start_position=False, *includes):
+    def feed(self, invoice_feed, start_position=False, *includes, prefetch=0, stream=False):
+        """
+        Handle all updates of the invoice feed
+        :param invoice_feed: InvoiceFeed handling the updates
+        :param start_position: position to resume after (if any)
+        :param includes: extra information to include (eg. meta, lastpayment)
+        :param prefetch: number of pages to fetch in the background while the current page is handled
+        :param stream: decode the pages while they are received, see TwikeyClient.feed_pages
+        """
+        for page in self.pages(start_position, *includes, prefetch=prefetch, stream=stream):
+            self.logger.debug("Feed handling : %d invoices from %s till %s" %
+                              (len(page.items), start_position, page.position))
+            invoice_feed.start(page.position, len(page.items))
+            error = False
+            for invoice in page.items:
+                self.logger.debug("Feed handling : %s" % invoice)
+                error = invoice_feed.invoice(invoice)
+                if error:
+                    break
+            if error:
+                self.logger.debug("Error while handing invoice, stopping")
+                break
+        self.logger.debug("Done handing invoice feed")
+
+    def pages(self, start_position=False, *includes, prefetch=0, stream=False):
+        """
+        Lazily iterate over the invoice feed page by page
+        :return: generator of FeedPage(position, invoices)
+        """
+        url = self._feed_url(includes)
+        return self.client.feed_pages("Invoice feed", url, "Invoices", start_position, prefetch, stream)
+
+    def items(self, start_position=False, *includes, prefetch=0, stream=False):
+        """Lazily iterate over all invoices of the feed"""
+        url = self._feed_url(includes)
+        return self.client.feed_items("Invoice feed", url, "Invoices", start_position, prefetch, stream)
+
+    def _feed_url(self, includes):
         _includes = ""
         for include in includes:
             _includes += "&include=" + include
-
-        url = self.client.instance_url("/invoice?include=customer" + _includes)
-        try:
-            self.client.refreshTokenIfRequired()
-            initheaders = self.client.headers()
-            if start_position:
-                initheaders["X-RESUME-AFTER"] = str(start_position)
-            response = requests.get(
-                url=url,
-                headers=initheaders,
-                timeout=15,
-            )
-            if "ApiErrorCode" in response.headers:
-                raise self.client.raise_error("Feed invoice", response)
-            feed_response = response.json()
-            while len(feed_response["Invoices"]) > 0:
-                number_of_invoices = len(feed_response["Invoices"])
-                last_invoice = response.headers["X-LAST"]
-                self.logger.debug("Feed handling : %d invoices from %s till %s" %
-                                  (number_of_invoices, start_position, last_invoice))
-                invoice_feed.start(response.headers["X-LAST"], len(feed_response["Invoices"]))
-                error = False
-                for invoice in feed_response["Invoices"]:
-                    self.logger.debug("Feed handling : %s" % invoice)
-                    error = invoice_feed.invoice(invoice)
-                    if error:
-                        break
-                if error:
-                    self.logger.debug("Error while handing invoice, stopping")
-                    break
-                response = requests.get(url=url, headers=self.client.headers(), timeout=15, )
-                if "ApiErrorCode" in response.headers:
-                    raise self.client.raise_error("Feed invoice", response)
-                feed_response = response.json()
-            self.logger.debug("Done handing invoice feed")
-        except requests.exceptions.RequestException as e:
-            raise self.client.raise_error_from_request("Invoice feed", e)
+        return self.client.instance_url("/invoice?include=customer" + _includes)
 
     def geturl(self, invoice_id):
         if '.beta.' in self.client.api_base:
@@ -11,7 +11,8 @@ class Paylink(object):
         data = data or {}
         try:
             self.client.refreshTokenIfRequired()
-            response = requests.post(
+            response = self.client.request(
+                "POST",
                 url=url,
                 data=data,
                 headers=self.client.headers(),
@@ -23,31 +24,31 @@ class Paylink(object):
         except requests.exceptions.RequestException as e:
             raise self.client.raise_error_from_request("Create paylink", e)
 
-    def feed(self, paylink_feed):
-        url = self.client.instance_url("/payment/link/feed")
-        try:
-            self.client.refreshTokenIfRequired()
-            response = requests.get(
-                url=url,
-                headers=self.client.headers(),
-                timeout=15,
-            )
-            if "ApiErrorCode" in response.headers:
-                raise self.client.raise_error("Feed paylink", response)
-            feed_response = response.json()
-            while len(feed_response["Links"]) > 0:
-                for msg in feed_response["Links"]:
-                    paylink_feed.paylink(msg)
-                response = requests.get(
-                    url=url,
-                    headers=self.client.headers(),
-                    timeout=15,
-                )
-                if "ApiErrorCode" in response.headers:
-                    raise self.client.raise_error("Feed paylink", response)
-                feed_response = response.json()
-        except requests.exceptions.RequestException as e:
-            raise self.client.raise_error_from_request("Feed paylink", e)
+    def feed(self, paylink_feed, start_position=False, prefetch=0, stream=False):
+        """
+        Handle all updates of the paylink feed
+        :param paylink_feed: instance of PaylinkFeed to handle the updates
+        :param start_position: position to resume after (if any)
+        :param prefetch: number of pages to fetch in the background while the current page is handled
+        :param stream: decode the pages while they are received, see TwikeyClient.feed_pages
+        """
+        for page in self.pages(start_position, prefetch, stream):
+            for msg in page.items:
+                paylink_feed.paylink(msg)
+
+    def pages(self, start_position=False, prefetch=0, stream=False):
+        """
+        Lazily iterate over the feed page by page
+        :return: generator of FeedPage(position, items)
+        """
+        return self.client.feed_pages("Feed paylink", self._feed_url(), "Links", start_position, prefetch, stream)
+
+    def items(self, start_position=False, prefetch=0, stream=False):
+        """Lazily iterate over all items of the feed"""
+        return self.client.feed_items("Feed paylink", self._feed_url(), "Links", start_position, prefetch, stream)
+
+    def _feed_url(self):
+        return self.client.instance_url("/payment/link/feed")
 
 
 class PaylinkFeed:
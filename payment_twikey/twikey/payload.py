@@ -0,0 +1,87 @@
+import base64
+import io
+import json
+
+
+class JsonFileBody(object):
+    """
+    Json request body of the form {...data, "field": "<base64 of file>"} produced while it is being sent, so a
+    (multi MB) pdf is never held as base64, str or json copy next to the original.
+    Offers what requests needs to stream it with a Content-Length (read, __iter__, __len__ and tell) and can be
+    rewound with seek(0) to send it again.
+    """
+
+    # raw bytes encoded at once, a multiple of 3 so the encoded pieces concatenate to valid base64
+    CHUNK_SIZE = 3 * 16 * 1024
+
+    def __init__(self, data, field, file) -> None:
+        """
+        :param data: json serializable dict with all other fields
+        :param field: name of the field holding the base64 encoded file
+        :param file: bytes or seekable binary file object, read from its current position
+        """
+        if isinstance(file, (bytes, bytearray, memoryview)):
+            file = io.BytesIO(file)
+        self.file = file
+        self.start = file.tell()
+        size = file.seek(0, io.SEEK_END) - self.start
+        file.seek(self.start)
+        head = json.dumps(data or {})[:-1]
+        separator = ", " if data else ""
+        self.prefix = (head + separator + json.dumps(field) + ': "').encode()
+        self.suffix = b'"}'
+        self.length = len(self.prefix) + 4 * ((size + 2) // 3) + len(self.suffix)
+        self.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if offset != 0 or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("Can only be rewound to the start")
+        self.file.seek(self.start)
+        self.pieces = self._pieces()
+        self.buffer = b""
+        self.offset = 0
+        self.position = 0
+        return 0
+
+    def read(self, size=-1):
+        out = bytearray()
+        while size is None or size < 0 or len(out) < size:
+            if self.offset >= len(self.buffer):
+                self.buffer = next(self.pieces, b"")
+                self.offset = 0
+                if not self.buffer:
+                    break
+            end = len(self.buffer) if size is None or size < 0 else self.offset + size - len(out)
+            out += self.buffer[self.offset:end]
+            self.offset = min(end, len(self.buffer))
+        self.position += len(out)
+        return bytes(out)
+
+    def _pieces(self):
+        yield self.prefix
+        rest = b""
+        while True:
+            raw = self.file.read(self.CHUNK_SIZE)
+            if not raw:
+                break
+            raw = rest + raw
+            cut = len(raw) - len(raw) % 3
+            rest = raw[cut:]
+            if cut:
+                yield base64.b64encode(raw[:cut])
+        if rest:
+            yield base64.b64encode(rest)
+        yield self.suffix
@@ -0,0 +1,51 @@
+import queue
+import threading
+
+_DONE = object()
+
+
+def prefetch(iterable, depth=1):
+    """
+    Iterate over iterable while a background thread already produces up to `depth` next items, allowing
+    eg. the next page of a feed to be downloaded while the current one is being handled.
+    Exceptions of the producer are raised in the consumer, stopping early (break/close) stops the producer.
+    :param iterable: the (blocking) iterable to consume, it is only touched from the background thread
+    :param depth: number of items fetched ahead, 0 to iterate without a background thread
+    """
+    if depth <= 0:
+        yield from iterable
+        return
+
+    buffer = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                buffer.put(entry, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((_DONE, None))
+        except BaseException as e:  # handed over to the consumer
+            put((_DONE, e))
+
+    producer = threading.Thread(target=produce, name="twikey-prefetch", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stopped.set()
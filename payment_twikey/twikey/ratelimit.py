@@ -0,0 +1,59 @@
+import random
+import threading
+import time
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared by all apis of a client (and all threads using it). Next to the steady rate,
+    Twikey can ask to back off for a while, which blocks every caller until that time has passed.
+    """
+
+    def __init__(self, rate=None, burst=None) -> None:
+        """
+        :param rate: number of calls per second, None or 0 to only honour the back off asked by Twikey
+        :param burst: number of calls that can be done at once after being idle, defaults to the rate
+        """
+        self.rate = float(rate or 0)
+        self.capacity = float(burst or max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until a call is allowed
+        :return: number of seconds waited
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def reserve(self):
+        """
+        Reserve a call without waiting, for callers that want to sleep themselves (eg. asyncio)
+        :return: number of seconds to wait before doing the call
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0.0, self.blocked_until - now)
+            if self.rate:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                # reserve the token now and sleep outside the lock, so waiting callers queue up fairly
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+        return wait
+
+    def pause(self, seconds):
+        """Block all callers for the given number of seconds"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """Exponential backoff with full jitter for the given (0 based) attempt"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
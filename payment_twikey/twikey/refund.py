@@ -27,7 +27,8 @@ class Refund(object):
         data = data or {}
         try:
             self.client.refreshTokenIfRequired()
-            response = requests.post(
+            response = self.client.request(
+                "POST",
                 url=url,
                 data=data,
                 headers=self.client.headers(),
@@ -69,7 +70,8 @@ class Refund(object):
         data["customerNumber"] = customerNumber
         try:
             self.client.refreshTokenIfRequired()
-            response = requests.post(
+            response = self.client.request(
+                "POST",
                 url=url,
                 data=data,
                 headers=self.client.headers(),
@@ -82,31 +84,31 @@ class Refund(object):
         except requests.exceptions.RequestException as e:
             raise self.client.raise_error_from_request("Create refund", e)
 
-    def feed(self, refund_feed):
-        url = self.client.instance_url("/transfer")
-        try:
-            self.client.refreshTokenIfRequired()
-            response = requests.get(
-                url=url,
-                headers=self.client.headers(),
-                timeout=15,
-            )
-            if "ApiErrorCode" in response.headers:
-                raise self.client.raise_error("Feed refunds", response)
-            feed_response = response.json()
-            while len(feed_response["Entries"]) > 0:
-                for msg in feed_response["Entries"]:
-                    refund_feed.refund(msg)
-                response = requests.get(
-                    url=url,
-                    headers=self.client.headers(),
-                    timeout=15,
-                )
-                if "ApiErrorCode" in response.headers:
-                    raise self.client.raise_error("Feed refunds", response)
-                feed_response = response.json()
-        except requests.exceptions.RequestException as e:
-            raise self.client.raise_error_from_request("Feed refunds", e)
+    def feed(self, refund_feed, start_position=False, prefetch=0, stream=False):
+        """
+        Handle all updates of the refund feed
+        :param refund_feed: instance of RefundFeed to handle the updates
+        :param start_position: position to resume after (if any)
+        :param prefetch: number of pages to fetch in the background while the current page is handled
+        :param stream: decode the pages while they are received, see TwikeyClient.feed_pages
+        """
+        for page in self.pages(start_position, prefetch, stream):
+            for msg in page.items:
+                refund_feed.refund(msg)
+
+    def pages(self, start_position=False, prefetch=0, stream=False):
+        """
+        Lazily iterate over the feed page by page
+        :return: generator of FeedPage(position, items)
+        """
+        return self.client.feed_pages("Feed refunds", self._feed_url(), "Entries", start_position, prefetch, stream)
+
+    def items(self, start_position=False, prefetch=0, stream=False):
+        """Lazily iterate over all items of the feed"""
+        return self.client.feed_items("Feed refunds", self._feed_url(), "Entries", start_position, prefetch, stream)
+
+    def _feed_url(self):
+        return self.client.instance_url("/transfer")
 
 
 class RefundFeed:
@@ -16,7 +16,8 @@ class Transaction(object):
         data = data or {}
         try:
             self.client.refreshTokenIfRequired()
-            response = requests.post(
+            response = self.client.request(
+                "POST",
                 url=url,
                 data=data,
                 headers=self.client.headers(),
@@ -29,36 +30,31 @@ class Transaction(object):
         except requests.exceptions.RequestException as e:
             raise self.client.raise_error_from_request("Create transaction", e)
 
-    def feed(self, transaction_feed):
+    def feed(self, transaction_feed, start_position=False, prefetch=0, stream=False):
         """
         See https://www.twikey.com/api/#transaction-feed
-        :param transaction_feed: instance of TransactionFeed to handle transaction updates
+        :param transaction_feed: instance of TransactionFeed to handle the updates
+        :param start_position: position to resume after (if any)
+        :param prefetch: number of pages to fetch in the background while the current page is handled
+        :param stream: decode the pages while they are received, see TwikeyClient.feed_pages
         """
-        url = self.client.instance_url("/transaction")
-        try:
-            self.client.refreshTokenIfRequired()
-            response = requests.get(
-                url=url,
-                headers=self.client.headers(),
-                timeout=15,
-            )
-            response.raise_for_status()
-            if "ApiErrorCode" in response.headers:
-                raise self.client.raise_error("Feed transaction", response)
-            feed_response = response.json()
-            while len(feed_response["Entries"]) > 0:
-                for msg in feed_response["Entries"]:
-                    transaction_feed.transaction(msg)
-                response = requests.get(
-                    url=url,
-                    headers=self.client.headers(),
-                    timeout=15,
-                )
-                if "ApiErrorCode" in response.headers:
-                    raise self.client.raise_error("Feed transaction", response)
-                feed_response = response.json()
-        except requests.exceptions.RequestException as e:
-            raise self.client.raise_error_from_request("Feed transaction", e)
+        for page in self.pages(start_position, prefetch, stream):
+            for msg in page.items:
+                transaction_feed.transaction(msg)
+
+    def pages(self, start_position=False, prefetch=0, stream=False):
+        """
+        Lazily iterate over the feed page by page
+        :return: generator of FeedPage(position, items)
+        """
+        return self.client.feed_pages("Feed transaction", self._feed_url(), "Entries", start_position, prefetch, stream)
+
+    def items(self, start_position=False, prefetch=0, stream=False):
+        """Lazily iterate over all items of the feed"""
+        return self.client.feed_items("Feed transaction", self._feed_url(), "Entries", start_position, prefetch, stream)
+
+    def _feed_url(self):
+        return self.client.instance_url("/transaction")
 
     def batch_send(self, ct, colltndt=False):
         """
@@ -73,7 +69,8 @@ class Transaction(object):
             data["colltndt"] = colltndt
         try:
             self.client.refreshTokenIfRequired()
-            response = requests.post(
+            response = self.client.request(
+                "POST",
                 url=url,
                 data=data,
                 headers=self.client.headers(),
@@ -93,7 +90,8 @@ class Transaction(object):
         url = self.client.instance_url("/collect/import")
         try:
             self.client.refreshTokenIfRequired()
-            response = requests.post(
+            response = self.client.request(
+                "POST",
                 url=url,
                 data=pain008_xml,
                 headers=self.client.headers(),
@@ -112,7 +110,8 @@ class Transaction(object):
         url = self.client.instance_url("/reporting")
         try:
             self.client.refreshTokenIfRequired()
-            response = requests.post(
+            response = self.client.request(
+                "POST",
                 url=url,
                 data=reporting_content,
                 headers=self.client.headers(),
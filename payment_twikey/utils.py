@@ -1,6 +1,32 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
 from odoo.addons.payment import utils as payment_utils
+from odoo.tools import config
 import re
 
+_logger = logging.getLogger(__name__)
+
+# first key of the advisory lock of a feed, the second one is the company
+FEED_LOCK_NAMESPACES = {
+    "invoice": 0x7717F1,
+    "mandate": 0x7717F2,
+    "transaction": 0x7717F3,
+    "refund": 0x7717F4,
+    "paylink": 0x7717F5,
+    "sender": 0x7717F6,
+}
+
+# returned by a feed run that was skipped as another worker is running the feed
+FEED_BUSY = "busy"
+
+_feed_lock_stats = defaultdict(lambda: {"acquired": 0, "skipped": 0, "wait": 0.0, "max_wait": 0.0, "held": 0.0})
+_feed_lock_stats_lock = threading.Lock()
+
 def get_twikey_customer(partner):
     if not partner:
         return {}
@@ -69,3 +95,144 @@ def field_name_from_attribute(attribute, profile_id):
 
 def sanitise_iban(iban):
     return re.sub(r'\W+', '', iban).upper()
+
+def run_concurrently(func, items, max_workers=8):
+    """
+    Call func for every item using a pool of threads, meant for the http calls towards Twikey only
+    (never touch the ORM from func as the cursor can't be shared between threads).
+    :return: list of (item, result, exception) in the order of items
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        results = []
+        for item in items:
+            try:
+                results.append((item, func(item), None))
+            except Exception as e:
+                results.append((item, None, e))
+        return results
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items)), thread_name_prefix="twikey") as executor:
+        return collect(submit_concurrently(executor, func, items))
+
+def submit_concurrently(executor, func, items):
+    """
+    Start func for every item on the executor without waiting for the results, so the caller can do other
+    work (with the ORM) in the meantime. Same restrictions on func as for run_concurrently.
+    :return: started calls to hand to collect
+    """
+    return [(item, executor.submit(func, item)) for item in items]
+
+def failed_call(item, exception):
+    """ A call for item that failed before it could be submitted, to hand to collect with the started ones """
+    future = Future()
+    future.set_exception(exception)
+    return item, future
+
+def collect(started):
+    """
+    Wait for the calls started by submit_concurrently
+    :return: list of (item, result, exception) in the order of items
+    """
+    results = []
+    for item, future in started:
+        try:
+            results.append((item, future.result(), None))
+        except Exception as e:
+            results.append((item, None, e))
+    return results
+
+def commit(env):
+    """ Commit the work done so far (eg. a page of a feed), except when running tests """
+    if not env.registry.in_test_mode():
+        env.cr.commit()
+
+
+@contextmanager
+def feed_lock(env, company, feed, timeout=0):
+    """
+    Make sure a single worker runs the given feed of a company at once, using a PostgreSQL advisory lock.
+    The lock is taken on a cursor of its own so it survives the commits done by the feed and doesn't lock
+    any row (eg. of res_company) the feed or users might want to write. That cursor is committed straight away,
+    the session lock survives it and no transaction is left open (holding back vacuum) while the feed runs.
+
+        with feed_lock(self.env, company, "invoice") as locked:
+            if locked:
+                ...
+
+    :param timeout: seconds to wait for a running feed to finish, 0 to give up straight away
+    :return: (as context) True when the lock was acquired
+    """
+    key = (FEED_LOCK_NAMESPACES[feed], company.id)
+    with env.registry.cursor() as cr:
+        started = time.monotonic()
+        while True:
+            cr.execute("SELECT pg_try_advisory_lock(%s, %s)", key)
+            locked = cr.fetchone()[0]
+            cr.commit()
+            waited = time.monotonic() - started
+            if locked or waited >= timeout:
+                break
+            time.sleep(min(0.5, timeout - waited))
+        _record_feed_lock(feed, locked, waited)
+        if not locked:
+            _logger.info("Twikey %s feed of %s already running, skipping (waited %.2fs)", feed, company.name, waited)
+            yield False
+            return
+        _logger.debug("Twikey %s feed lock of %s acquired after %.2fs", feed, company.name, waited)
+        acquired = time.monotonic()
+        try:
+            yield True
+        finally:
+            cr.execute("SELECT pg_advisory_unlock(%s, %s)", key)
+            cr.commit()
+            with _feed_lock_stats_lock:
+                _feed_lock_stats[feed]["held"] += time.monotonic() - acquired
+
+def _record_feed_lock(feed, locked, waited):
+    with _feed_lock_stats_lock:
+        stats = _feed_lock_stats[feed]
+        stats["acquired" if locked else "skipped"] += 1
+        stats["wait"] += waited
+        stats["max_wait"] = max(stats["max_wait"], waited)
+
+def feed_lock_stats():
+    """
+    Lock metrics of the feeds in this worker since it started
+    :return: dict per feed with the number of runs (acquired), runs skipped as the feed was busy (skipped),
+             total and max seconds spent waiting for the lock and total seconds it was held
+    """
+    with _feed_lock_stats_lock:
+        return {feed: dict(stats) for feed, stats in _feed_lock_stats.items()}
+
+
+class TimeBudget(object):
+    """
+    Time a cron job may spend before stopping cleanly, committing what was done and triggering itself again,
+    rather than being killed by limit_time_real (losing everything since the last commit).
+    """
+
+    def __init__(self, seconds=None):
+        self.deadline = time.monotonic() + seconds if seconds else None
+
+    @classmethod
+    def for_cron(cls, env):
+        """
+        Budget of twikey.cron_time_budget seconds, by default 60% of the time limit of the cron workers
+        (0 for no limit)
+        """
+        seconds = env["ir.config_parameter"].sudo().get_param("twikey.cron_time_budget")
+        if seconds is None or seconds is False:
+            limit = config.get("limit_time_real_cron", -1)
+            if limit is None or limit < 0:
+                limit = config.get("limit_time_real", 0)
+            seconds = limit * 0.6 if limit else 0
+        return cls(float(seconds))
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
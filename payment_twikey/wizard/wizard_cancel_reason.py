@@ -1,6 +1,5 @@
 import logging
 
-from ..twikey.client import TwikeyError
 from odoo import _, fields, models
 from odoo.exceptions import UserError
 
@@ -15,14 +14,10 @@ class MandateCancelReason(models.TransientModel):
 
     def action_cancel_confirm(self):
         if self.name:
-            twikey_client = self.env["ir.config_parameter"].get_twikey_client(company=self.env.company)
-            if twikey_client:
-                try:
-                    twikey_client.document.cancel(self.mandate_id.reference, self.name)
-                    self.mandate_id.update_feed()
-                except TwikeyError as te:
-                    raise UserError(_("This mandate could not be cancelled: %s") % te.get_error())
-                except Exception as ex:
-                    raise UserError(_("This mandate could not be cancelled: %s") % ex)
+            if self.env.company.twikey_api_key:
+                # cancelled in Twikey once committed, the mandate feed then picks up the cancellation
+                self.env["twikey.outbox"].enqueue(self.env.company, "mandate_cancel", self.mandate_id.reference,
+                                                  {"rsn": self.name})
+                self.mandate_id.message_post(body=f"Cancellation of Twikey mandate {self.mandate_id.reference} requested")
         else:
             raise UserError(_("Add reason to cancel the mandate!"))